@@ -0,0 +1,10 @@
+# File Location: testlab/backend/ai_system/conftest.py
+
+import os
+import sys
+import tempfile
+
+# langchain_router builds its module-level system under ./config and ./data on import,
+# so keep that out of the source tree
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="ai-router-tests-"))
@@ -6,12 +6,31 @@ Configurable keyword routing system for optimal LLM selection
 """
 
 import os
+import sys
+import fcntl
+import copy
 import json
+import time
+import heapq
+import bisect
+import socket
+import sqlite3
+import asyncio
+import hashlib
+import hmac
+import threading
+import functools
+import tracemalloc
+import httpx
 import yaml
 from pathlib import Path
-from typing import Dict, List, Optional, Any, Tuple
-from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Any, Tuple, Callable
+from dataclasses import dataclass, field, asdict
 from datetime import datetime
+from collections import Counter, OrderedDict, deque
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 import logging
 from enum import Enum
 
@@ -22,12 +41,26 @@ from langchain.chains import LLMChain, ConversationChain
 from langchain.memory import ConversationBufferMemory, ConversationSummaryMemory
 from langchain.prompts import PromptTemplate, ChatPromptTemplate
 from langchain.agents import initialize_agent, Tool, AgentType
-from langchain.callbacks import CallbackManager, StreamingStdOutCallbackHandler
-from langchain.schema import BaseMessage, HumanMessage, AIMessage
+from langchain.schema import BaseMessage, HumanMessage, AIMessage, LLMResult
+from langchain.prompts.chat import ChatPromptValue
 from langchain.embeddings import OpenAIEmbeddings
 from langchain.vectorstores import Chroma
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+# Optional: only needed for offline routing replay
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = None
+    sparse = None
+
+# Optional: exact token counts for pre-call budget estimates
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -52,14 +85,87 @@ class RoutingConfig:
     weight: float = 1.0
     context_keywords: List[str] = field(default_factory=list)
     min_confidence: float = 0.7
+
+@dataclass
+class SessionContext:
+    """Running, decayed context-keyword presence for one conversation session
+    
+    Seeded from the history the client sent when the session started, then folded forward
+    with each turn's query and response. With decay 1.0 nothing fades, so routing matches
+    a scan of all of that text at once.
+    """
+    decay: float = 0.8
+    presence: Dict[str, float] = field(default_factory=dict)
+    
+    def update(self, turn: str, keywords: List[str]):
+        """Fold in the newest turn only; older turns fade by the decay factor"""
+        turn_lower = turn.lower()
+        for keyword in list(self.presence):
+            self.presence[keyword] *= self.decay
+            if self.presence[keyword] < 0.01:
+                del self.presence[keyword]
+        for keyword in keywords:
+            if keyword in turn_lower:
+                self.presence[keyword] = self.presence.get(keyword, 0.0) + 1.0
     
+class RoutingDecisionCache:
+    """Bounded LRU cache of routing decisions tagged with the routing config version"""
+    
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+    
+    def get(self, key: Tuple, version: int) -> Optional[Tuple[str, float]]:
+        """Cached (category, confidence), or None if missing or from an older config"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] != version:
+                # Entries from an older config are dropped lazily, so invalidation is O(1)
+                del self._entries[key]
+                self.stale += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, key: Tuple, decision: Tuple[str, float], version: int):
+        with self._lock:
+            self._entries[key] = (version, decision)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def get_stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
 class KeywordRouter:
     """Advanced keyword-based routing system"""
     
-    def __init__(self, config_path: str = "./config/routing_config.yaml"):
+    def __init__(self, config_path: str = "./config/routing_config.yaml", cache_size: int = 10000):
         self.config_path = Path(config_path)
         self.routing_rules = self._load_routing_config()
-        self.keyword_cache = {}
+        self.config_version = 0
+        self.keyword_cache = RoutingDecisionCache(cache_size)
         
     def _load_routing_config(self) -> Dict[str, RoutingConfig]:
         """Load routing configuration from YAML file"""
@@ -70,8 +176,13 @@ class KeywordRouter:
         with open(self.config_path, 'r') as f:
             config_data = yaml.safe_load(f)
         
+        return self.parse_routing_rules(config_data['routing_rules'])
+    
+    @staticmethod
+    def parse_routing_rules(rules_data: Dict[str, Dict]) -> Dict[str, RoutingConfig]:
+        """Build RoutingConfig objects from the routing_rules section of the config"""
         routing_rules = {}
-        for category, rules in config_data['routing_rules'].items():
+        for category, rules in rules_data.items():
             routing_rules[category] = RoutingConfig(
                 keywords=rules['keywords'],
                 primary_llm=LLMType(rules['primary_llm']),
@@ -156,28 +267,47 @@ class KeywordRouter:
                 'openai_gpt4': {
                     'model': 'gpt-4',
                     'temperature': 0.2,
-                    'max_tokens': 2000
+                    'max_tokens': 2000,
+                    'prompt_price_per_1k': 0.03,
+                    'completion_price_per_1k': 0.06
                 },
                 'openai_gpt35': {
                     'model': 'gpt-3.5-turbo',
                     'temperature': 0.3,
-                    'max_tokens': 1500
+                    'max_tokens': 1500,
+                    'prompt_price_per_1k': 0.0015,
+                    'completion_price_per_1k': 0.002
                 },
                 'claude_3': {
                     'model': 'claude-3-opus-20240229',
                     'temperature': 0.2,
-                    'max_tokens': 2000
+                    'max_tokens': 2000,
+                    'prompt_price_per_1k': 0.015,
+                    'completion_price_per_1k': 0.075
                 },
                 'claude_2': {
                     'model': 'claude-2.1',
                     'temperature': 0.3,
-                    'max_tokens': 1500
+                    'max_tokens': 1500,
+                    'prompt_price_per_1k': 0.008,
+                    'completion_price_per_1k': 0.024
                 },
                 'llama_70b': {
                     'model': 'meta-llama/Llama-2-70b-chat-hf',
                     'temperature': 0.2,
-                    'max_tokens': 1500
+                    'max_tokens': 1500,
+                    'prompt_price_per_1k': 0.0009,
+                    'completion_price_per_1k': 0.0009
                 }
+            },
+            'budgets': {
+                'policy': 'degrade',
+                'window_seconds': 86400,
+                'callers': {},
+                'categories': {}
+            },
+            'scheduler': {
+                'caller_weights': {}
             }
         }
         
@@ -185,9 +315,42 @@ class KeywordRouter:
         with open(self.config_path, 'w') as f:
             yaml.dump(default_config, f, default_flow_style=False)
     
-    def route(self, query: str, context: Optional[str] = None) -> Tuple[str, RoutingConfig, float]:
+    def route(self, query: str, context: Optional[str] = None,
+              session_context: Optional[SessionContext] = None) -> Tuple[str, RoutingConfig, float]:
         """Route query to appropriate LLM category based on keywords"""
+        # Read the version first so a concurrent config update leaves this entry stale
+        version = self.config_version
         query_lower = query.lower()
+        context_presence = self._context_presence(context, session_context)
+        
+        # Keyword matching is substring-based, so lowercasing is the only safe normalization
+        cache_key = (
+            hashlib.blake2b(query_lower.encode(), digest_size=16).digest(),
+            hash(frozenset(context_presence.items()))
+        )
+        cached = self.keyword_cache.get(cache_key, version)
+        if cached is not None:
+            category, confidence = cached
+            return category, self._config_for(category), confidence
+        
+        category, confidence = self._score(query_lower, context_presence)
+        self.keyword_cache.put(cache_key, (category, confidence), version)
+        return category, self._config_for(category), confidence
+    
+    def _context_presence(self, context: Optional[str],
+                          session_context: Optional[SessionContext]) -> Dict[str, float]:
+        """Weight (0-1) of each context keyword present in the session or context string"""
+        if session_context is not None:
+            # Steps of 0.1 for both scoring and the cache key: decayed weights would otherwise
+            # change every turn and session traffic would never hit the cache
+            quantized = {kw: round(min(weight, 1.0), 1) for kw, weight in session_context.presence.items()}
+            return {kw: weight for kw, weight in quantized.items() if weight}
+        if context:
+            context_lower = context.lower()
+            return {kw: 1.0 for kw in self.all_context_keywords() if kw in context_lower}
+        return {}
+    
+    def _score(self, query_lower: str, context_presence: Dict[str, float]) -> Tuple[str, float]:
         scores = {}
         
         for category, config in self.routing_rules.items():
@@ -199,11 +362,8 @@ class KeywordRouter:
                     score += config.weight
             
             # Check context keywords if context provided
-            if context and config.context_keywords:
-                context_lower = context.lower()
-                for keyword in config.context_keywords:
-                    if keyword in context_lower:
-                        score += config.weight * 0.5
+            for keyword in config.context_keywords:
+                score += config.weight * 0.5 * context_presence.get(keyword, 0.0)
             
             scores[category] = score
         
@@ -213,10 +373,26 @@ class KeywordRouter:
             confidence = scores[best_category] / (len(self.routing_rules[best_category].keywords) * self.routing_rules[best_category].weight) if self.routing_rules[best_category].keywords else 0.5
             
             if confidence >= self.routing_rules[best_category].min_confidence:
-                return best_category, self.routing_rules[best_category], confidence
+                return best_category, confidence
         
         # Default fallback
-        return 'general', self.routing_rules.get('general', list(self.routing_rules.values())[0]), 0.5
+        return 'general', 0.5
+    
+    def _config_for(self, category: str) -> RoutingConfig:
+        if category in self.routing_rules:
+            return self.routing_rules[category]
+        return self.routing_rules.get('general', list(self.routing_rules.values())[0])
+    
+    def set_rules(self, routing_rules: Dict[str, RoutingConfig]):
+        """Replace the routing rules, invalidate cached decisions and save them to disk"""
+        # Rules before version: a concurrent route() then at worst caches under the old version
+        self.routing_rules = routing_rules
+        self.config_version += 1
+        self._save_config()
+    
+    def all_context_keywords(self) -> List[str]:
+        """Context keywords across all categories"""
+        return list({kw for config in self.routing_rules.values() for kw in config.context_keywords})
     
     def update_keywords(self, category: str, keywords: List[str], append: bool = True):
         """Update keywords for a category"""
@@ -225,10 +401,25 @@ class KeywordRouter:
                 self.routing_rules[category].keywords.extend(keywords)
             else:
                 self.routing_rules[category].keywords = keywords
+            self.config_version += 1
             
             # Save updated configuration
             self._save_config()
     
+    def serialize_rules(self) -> Dict[str, Dict]:
+        """Routing rules in the routing_rules config format"""
+        return {
+            category: {
+                'keywords': list(config.keywords),
+                'primary_llm': config.primary_llm.value,
+                'secondary_llms': [llm.value for llm in config.secondary_llms],
+                'weight': config.weight,
+                'context_keywords': list(config.context_keywords),
+                'min_confidence': config.min_confidence
+            }
+            for category, config in self.routing_rules.items()
+        }
+    
     def _save_config(self):
         """Save current configuration to file"""
         config_data = {
@@ -236,35 +427,963 @@ class KeywordRouter:
             'llm_configurations': {}
         }
         
-        for category, config in self.routing_rules.items():
-            config_data['routing_rules'][category] = {
-                'keywords': config.keywords,
-                'primary_llm': config.primary_llm.value,
-                'secondary_llms': [llm.value for llm in config.secondary_llms],
-                'weight': config.weight,
-                'context_keywords': config.context_keywords,
-                'min_confidence': config.min_confidence
-            }
+        # Keep non-routing sections such as llm_configurations and budgets
+        if self.config_path.exists():
+            with open(self.config_path, 'r') as f:
+                existing = yaml.safe_load(f) or {}
+            config_data.update({key: value for key, value in existing.items() if key != 'routing_rules'})
+        config_data['routing_rules'] = self.serialize_rules()
         
-        with open(self.config_path, 'w') as f:
+        # Workers may share config_dir, so never leave a half-written file behind
+        tmp_path = self.config_path.with_suffix(f'.yaml.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
             yaml.dump(config_data, f, default_flow_style=False)
+        os.replace(tmp_path, self.config_path)
+
+class RoutingReplay:
+    """Offline what-if routing over logged queries using a sparse query x keyword match matrix"""
+    
+    CONFIDENCE_BINS = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+    
+    def __init__(self, queries: List[str], contexts: Optional[List[str]] = None):
+        if np is None or sparse is None:
+            raise RuntimeError("Routing replay requires numpy and scipy")
+        self.size = len(queries)
+        self._sources = {'query': self._index(queries)}
+        if contexts is not None:
+            self._sources['context'] = self._index([context or '' for context in contexts])
+        self._rows = {}
+    
+    @staticmethod
+    def _index(texts: List[str]) -> Tuple[str, Any]:
+        """Join lowercased texts so each keyword is located with C-level str.find"""
+        lowered = [text.lower() for text in texts]
+        lengths = np.fromiter((len(text) + 1 for text in lowered), dtype=np.int64, count=len(lowered))
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])) if len(lowered) else lengths
+        return '\x00'.join(lowered), offsets
+    
+    def _keyword_rows(self, keyword: str, source: str):
+        """Row indices whose text contains keyword (cached per keyword)"""
+        cache_key = (source, keyword)
+        if cache_key not in self._rows:
+            text, offsets = self._sources[source]
+            if not keyword:
+                # An empty keyword matches any query, but route() skips empty contexts
+                rows = np.arange(self.size) if source == 'query' else \
+                    np.flatnonzero(np.diff(np.append(offsets, len(text) + 1)) > 1)
+            else:
+                positions = []
+                position = text.find(keyword)
+                while position != -1:
+                    positions.append(position)
+                    position = text.find(keyword, position + 1)
+                rows = np.unique(np.searchsorted(offsets, np.array(positions, dtype=np.int64), side='right') - 1)
+            self._rows[cache_key] = rows
+        return self._rows[cache_key]
+    
+    def _score(self, rules: Dict[str, RoutingConfig], source: str, context_weight: bool):
+        """Q x C score matrix: match matrix (Q x K) times keyword weights (K x C)"""
+        keywords = sorted({kw for config in rules.values()
+                           for kw in (config.context_keywords if context_weight else config.keywords)})
+        column = {kw: i for i, kw in enumerate(keywords)}
+        
+        weights = np.zeros((len(keywords), len(rules)))
+        for c, config in enumerate(rules.values()):
+            for kw in (config.context_keywords if context_weight else config.keywords):
+                weights[column[kw], c] += config.weight * (0.5 if context_weight else 1.0)
+        
+        rows = [self._keyword_rows(kw, source) for kw in keywords]
+        indices = np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+        columns = np.repeat(np.arange(len(keywords)), [len(r) for r in rows])
+        matches = sparse.csr_matrix(
+            (np.ones(len(indices)), (indices, columns)),
+            shape=(self.size, len(keywords))
+        )
+        return np.asarray(matches @ weights)
+    
+    def evaluate(self, rules: Dict[str, RoutingConfig]) -> Tuple[List[str], Any, Any]:
+        """Vectorized equivalent of KeywordRouter.route for every logged query"""
+        categories = list(rules.keys())
+        configs = list(rules.values())
+        scores = self._score(rules, 'query', False)
+        if 'context' in self._sources:
+            context_mask = np.array([bool(config.context_keywords) for config in configs])
+            scores = scores + self._score(rules, 'context', True) * context_mask
+        
+        best = scores.argmax(axis=1)
+        keyword_counts = np.array([len(config.keywords) for config in configs], dtype=float)
+        config_weights = np.array([config.weight for config in configs])
+        min_confidence = np.array([config.min_confidence for config in configs])
+        
+        denominator = (keyword_counts * config_weights)[best]
+        best_scores = scores[np.arange(self.size), best]
+        confidence = np.where(keyword_counts[best] > 0,
+                              best_scores / np.where(denominator == 0, 1, denominator), 0.5)
+        
+        # Index len(categories) stands for the 'general' fallback
+        routed = confidence >= min_confidence[best]
+        assigned = np.where(routed, best, len(categories))
+        return categories + ['general'], assigned, np.where(routed, confidence, 0.5)
+    
+    def _distribution(self, confidence) -> Dict:
+        if not self.size:
+            return {'mean': 0.0, 'p50': 0.0, 'p90': 0.0, 'histogram': []}
+        counts, edges = np.histogram(np.clip(confidence, 0.0, 1.0), bins=self.CONFIDENCE_BINS)
+        return {
+            'mean': float(confidence.mean()),
+            'p50': float(np.percentile(confidence, 50)),
+            'p90': float(np.percentile(confidence, 90)),
+            'histogram': [
+                {'bin': f"{edges[i]:.1f}-{edges[i + 1]:.1f}", 'count': int(counts[i])}
+                for i in range(len(counts))
+            ]
+        }
+    
+    def compare(self, baseline: Dict[str, RoutingConfig], candidate: Dict[str, RoutingConfig]) -> Dict:
+        """Report how routing shifts from the baseline to the candidate config"""
+        base_names, base_assigned, base_confidence = self.evaluate(baseline)
+        cand_names, cand_assigned, cand_confidence = self.evaluate(candidate)
+        
+        base_labels = np.array(base_names, dtype=object)[base_assigned] if self.size else np.array([], dtype=object)
+        cand_labels = np.array(cand_names, dtype=object)[cand_assigned] if self.size else np.array([], dtype=object)
+        changed = base_labels != cand_labels
+        
+        transitions = Counter(zip(base_labels[changed], cand_labels[changed]))
+        return {
+            'total_queries': self.size,
+            'changed': int(changed.sum()),
+            'dropped_to_general': int(((base_labels != 'general') & (cand_labels == 'general')).sum()),
+            'general': {
+                'baseline': int((base_labels == 'general').sum()),
+                'candidate': int((cand_labels == 'general').sum())
+            },
+            'categories': {
+                'baseline': dict(Counter(base_labels.tolist())),
+                'candidate': dict(Counter(cand_labels.tolist()))
+            },
+            'transitions': [
+                {'from': src, 'to': dst, 'count': count}
+                for (src, dst), count in transitions.most_common()
+            ],
+            'confidence': {
+                'baseline': self._distribution(base_confidence),
+                'candidate': self._distribution(cand_confidence)
+            }
+        }
+
+class SamplingProfiler:
+    """Low-overhead wall-clock sampler producing collapsed (flamegraph) stacks"""
+    
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = None
+        self._thread = None
+        self._stop_event = threading.Event()
+    
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+    
+    def start(self, interval: Optional[float] = None):
+        """Start sampling all threads of this worker"""
+        if self.running:
+            raise RuntimeError("Profiler already running")
+        if interval:
+            self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = time.time()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+    
+    def stop(self) -> str:
+        """Stop sampling and return stacks in Brendan Gregg's folded format"""
+        if not self.running:
+            raise RuntimeError("Profiler is not running")
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        return self.folded()
+    
+    def folded(self) -> str:
+        """Render samples as 'frame;frame;frame count' lines"""
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+    
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+class MemoryProfiler:
+    """tracemalloc snapshots and diffs for tracking memory growth"""
+    
+    def __init__(self, frames: int = 10):
+        self.frames = frames
+        self.baseline = None
+    
+    def snapshot(self, limit: int = 25) -> Dict:
+        """Take a snapshot, keep it as the diff baseline and return top allocations"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        snapshot = tracemalloc.take_snapshot()
+        self.baseline = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'current_bytes': current,
+            'peak_bytes': peak,
+            'top': [
+                {'location': str(stat.traceback), 'size_bytes': stat.size, 'count': stat.count}
+                for stat in snapshot.statistics('lineno')[:limit]
+            ]
+        }
+    
+    def diff(self, limit: int = 25) -> Dict:
+        """Compare a fresh snapshot against the baseline"""
+        if self.baseline is None:
+            raise RuntimeError("No baseline snapshot; take a snapshot first")
+        snapshot = tracemalloc.take_snapshot()
+        stats = snapshot.compare_to(self.baseline, 'lineno')
+        return {
+            'top': [
+                {
+                    'location': str(stat.traceback),
+                    'size_diff_bytes': stat.size_diff,
+                    'size_bytes': stat.size,
+                    'count_diff': stat.count_diff
+                }
+                for stat in stats[:limit]
+            ]
+        }
+    
+    def stop(self):
+        """Stop tracing and drop the baseline"""
+        tracemalloc.stop()
+        self.baseline = None
+
+@dataclass
+class SlowQueryRecord:
+    """Full routing decision and timings for a slow process_query call"""
+    timestamp: str
+    query: str
+    category: str
+    confidence: float
+    primary_llm: str
+    secondary_llms: List[str]
+    query_chars: int
+    total_ms: float
+    timings_ms: Dict[str, float] = field(default_factory=dict)
+    # One entry per LLM call (primary, secondary, blend) with the prompt actually sent
+    calls: List[Dict] = field(default_factory=list)
+    error: Optional[str] = None
+
+class SlowQueryRecorder:
+    """Keeps the most recent process_query calls above a latency threshold"""
+    
+    def __init__(self, threshold_ms: float = 5000.0, max_records: int = 200):
+        self.threshold_ms = threshold_ms
+        self.records = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+    
+    def is_slow(self, total_ms: float) -> bool:
+        return total_ms >= self.threshold_ms
+    
+    def observe(self, record: SlowQueryRecord) -> bool:
+        """Store the record if it exceeded the threshold"""
+        if not self.is_slow(record.total_ms):
+            return False
+        with self._lock:
+            self.records.append(record)
+        logger.warning(f"Slow query ({record.total_ms:.0f}ms) routed to {record.category}")
+        return True
+    
+    def get_records(self) -> List[Dict]:
+        with self._lock:
+            return [asdict(record) for record in self.records]
+    
+    def clear(self):
+        with self._lock:
+            self.records.clear()
+
+class AdmissionRejected(Exception):
+    """Raised when the scheduler refuses or drops a query"""
+    
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+@dataclass(order=True)
+class _AdmissionTicket:
+    finish_tag: float
+    seq: int
+    caller: str = field(compare=False)
+    priority: str = field(compare=False)
+    deadline: Optional[float] = field(compare=False)
+    future: Any = field(compare=False)
+
+class AdmissionScheduler:
+    """Priority classes with weighted fair queuing per caller in front of process_query"""
+    
+    PRIORITY_CLASSES = ('interactive', 'batch')
+    
+    def __init__(self, max_concurrent: int = 8, max_queue_depth: Optional[Dict[str, int]] = None,
+                 max_caller_depth: int = 50, caller_weights: Optional[Dict[str, float]] = None):
+        self.max_concurrent = max_concurrent
+        self.max_queue_depth = max_queue_depth or {'interactive': 200, 'batch': 1000}
+        self.max_caller_depth = max_caller_depth
+        self.caller_weights = caller_weights or {}
+        self.active = 0
+        self.service_time_ewma = 0.0
+        self.queues = {cls: [] for cls in self.PRIORITY_CLASSES}
+        self.virtual_time = {cls: 0.0 for cls in self.PRIORITY_CLASSES}
+        self.caller_finish = {cls: {} for cls in self.PRIORITY_CLASSES}
+        # Live waiters only; abandoned tickets stay in the heaps until popped
+        self.queue_depth = Counter()
+        self.caller_depth = Counter()
+        self.counters = Counter()
+        self._seq = 0
+    
+    @asynccontextmanager
+    async def slot(self, caller: str, priority: str = 'interactive', deadline: Optional[float] = None):
+        """Hold an execution slot; deadline is an absolute time.monotonic() value"""
+        await self.acquire(caller, priority, deadline)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+    
+    async def acquire(self, caller: str, priority: str = 'interactive', deadline: Optional[float] = None):
+        """Wait for an execution slot or raise AdmissionRejected"""
+        if priority not in self.PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class: {priority}")
+        
+        if not self._can_finish(deadline, self._queued_ahead(priority)):
+            self.counters[f'{priority}_dropped_deadline'] += 1
+            raise AdmissionRejected('deadline', "Query cannot complete before its deadline")
+        
+        if self.active < self.max_concurrent and self._queued_ahead(priority) == 0:
+            self.active += 1
+            self.counters[f'{priority}_admitted'] += 1
+            return
+        
+        if self.queue_depth[priority] >= self.max_queue_depth[priority]:
+            self.counters[f'{priority}_rejected_queue_full'] += 1
+            raise AdmissionRejected('queue_full', f"{priority} queue is full")
+        if self.caller_depth[caller] >= self.max_caller_depth:
+            self.counters[f'{priority}_rejected_caller_limit'] += 1
+            raise AdmissionRejected('queue_full', "Too many queued queries for this caller")
+        
+        # Start-time fair queuing: tag by the later of virtual time and the caller's last finish
+        weight = self.caller_weights.get(caller, 1.0)
+        start_tag = max(self.virtual_time[priority], self.caller_finish[priority].get(caller, 0.0))
+        finish_tag = start_tag + 1.0 / weight
+        self.caller_finish[priority][caller] = finish_tag
+        
+        self._seq += 1
+        ticket = _AdmissionTicket(finish_tag, self._seq, caller, priority, deadline,
+                                  asyncio.get_running_loop().create_future())
+        heapq.heappush(self.queues[priority], ticket)
+        self.queue_depth[priority] += 1
+        self.caller_depth[caller] += 1
+        
+        timeout = max(deadline - time.monotonic(), 0.0) if deadline else None
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), timeout)
+        except asyncio.TimeoutError:
+            self._abandon(ticket)
+            self.counters[f'{priority}_dropped_deadline'] += 1
+            raise AdmissionRejected('deadline', "Deadline expired while queued")
+        except asyncio.CancelledError:
+            self._abandon(ticket)
+            raise
+        self.counters[f'{priority}_admitted'] += 1
+    
+    def release(self, service_time: float):
+        """Return a slot and hand it to the next eligible ticket"""
+        self.active -= 1
+        self.service_time_ewma = service_time if not self.service_time_ewma else \
+            0.8 * self.service_time_ewma + 0.2 * service_time
+        self._dispatch()
+    
+    def _dispatch(self):
+        while self.active < self.max_concurrent:
+            ticket = self._pop_next()
+            if ticket is None:
+                return
+            if not self._can_finish(ticket.deadline, 0):
+                self.counters['dropped_deadline_at_dispatch'] += 1
+                ticket.future.set_exception(
+                    AdmissionRejected('deadline', "Query can no longer finish before its deadline"))
+                continue
+            self.active += 1
+            ticket.future.set_result(True)
+    
+    def _pop_next(self) -> Optional[_AdmissionTicket]:
+        for priority in self.PRIORITY_CLASSES:
+            queue = self.queues[priority]
+            while queue:
+                ticket = heapq.heappop(queue)
+                if ticket.future.done():
+                    continue
+                self._dequeue(ticket)
+                self.virtual_time[priority] = ticket.finish_tag
+                if self.caller_finish[priority].get(ticket.caller, 0.0) <= ticket.finish_tag:
+                    self.caller_finish[priority].pop(ticket.caller, None)
+                return ticket
+        return None
+    
+    def _dequeue(self, ticket: _AdmissionTicket):
+        self.queue_depth[ticket.priority] -= 1
+        self.caller_depth[ticket.caller] -= 1
+        if not self.caller_depth[ticket.caller]:
+            del self.caller_depth[ticket.caller]
+    
+    def _abandon(self, ticket: _AdmissionTicket):
+        if ticket.future.done() and not ticket.future.cancelled() and ticket.future.exception() is None:
+            # Slot was granted just as the waiter gave up; hand it on
+            self.active -= 1
+            self._dispatch()
+        elif not ticket.future.done():
+            ticket.future.cancel()
+            self._dequeue(ticket)
+            # Drop dead tickets once they outnumber live ones so the heap stays bounded
+            queue = self.queues[ticket.priority]
+            if len(queue) > 2 * self.queue_depth[ticket.priority] + 64:
+                queue[:] = [entry for entry in queue if not entry.future.done()]
+                heapq.heapify(queue)
+    
+    def _queued_ahead(self, priority: str) -> int:
+        ahead = 0
+        for cls in self.PRIORITY_CLASSES:
+            ahead += self.queue_depth[cls]
+            if cls == priority:
+                break
+        return ahead
+    
+    def _can_finish(self, deadline: Optional[float], queued_ahead: int) -> bool:
+        if deadline is None or not self.service_time_ewma:
+            return deadline is None or deadline > time.monotonic()
+        expected_wait = (queued_ahead / self.max_concurrent) * self.service_time_ewma
+        return time.monotonic() + expected_wait + self.service_time_ewma <= deadline
+    
+    def get_stats(self) -> Dict:
+        return {
+            'active': self.active,
+            'max_concurrent': self.max_concurrent,
+            'queue_depth': {cls: self.queue_depth[cls] for cls in self.PRIORITY_CLASSES},
+            'service_time_ewma_ms': self.service_time_ewma * 1000,
+            'counters': dict(self.counters)
+        }
+
+class SharedStateStore(ABC):
+    """Key/value store for state shared between workers; values are JSON-serializable"""
+    
+    @abstractmethod
+    def get(self, key: str, default: Any = None) -> Any:
+        pass
+    
+    @abstractmethod
+    def set(self, key: str, value: Any):
+        pass
+    
+    @abstractmethod
+    def delete(self, key: str):
+        pass
+    
+    @abstractmethod
+    def incr_many(self, amounts: Dict[str, float]) -> Dict[str, float]:
+        """Atomically add to several numeric keys, returning the new values"""
+        pass
+    
+    def incr(self, key: str, amount: float = 1) -> float:
+        return self.incr_many({key: amount})[key]
+    
+    @abstractmethod
+    def update(self, keys: List[str], fn: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Any]:
+        """Atomically read keys (missing ones as None), write the entries fn returns and return them"""
+        pass
+    
+    @abstractmethod
+    def items(self, prefix: str) -> Dict[str, Any]:
+        """All entries whose key starts with prefix"""
+        pass
+
+class InMemoryStateStore(SharedStateStore):
+    """Process-local store used for single-worker mode and tests"""
+    
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            return self._data.get(key, default)
+    
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._data[key] = value
+    
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def incr_many(self, amounts: Dict[str, float]) -> Dict[str, float]:
+        with self._lock:
+            for key, amount in amounts.items():
+                self._data[key] = self._data.get(key, 0) + amount
+            return {key: self._data[key] for key in amounts}
+    
+    def update(self, keys: List[str], fn: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Any]:
+        with self._lock:
+            # Copies, so a failing fn can't leave half-applied changes behind
+            changes = fn({key: copy.deepcopy(self._data.get(key)) for key in keys})
+            self._data.update(changes)
+            return changes
+    
+    def items(self, prefix: str) -> Dict[str, Any]:
+        with self._lock:
+            return {key: value for key, value in self._data.items() if key.startswith(prefix)}
+
+class SQLiteStateStore(SharedStateStore):
+    """SQLite-backed store shared by all workers on one host"""
+    
+    def __init__(self, path: str):
+        self.path = str(path)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS shared_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+    
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+    
+    def get(self, key: str, default: Any = None) -> Any:
+        row = self._connect().execute("SELECT value FROM shared_state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+    
+    def set(self, key: str, value: Any):
+        self._connect().execute(
+            "INSERT INTO shared_state (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, json.dumps(value))
+        )
+    
+    def delete(self, key: str):
+        self._connect().execute("DELETE FROM shared_state WHERE key = ?", (key,))
+    
+    def incr_many(self, amounts: Dict[str, float]) -> Dict[str, float]:
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            results = {}
+            for key, amount in amounts.items():
+                row = conn.execute("SELECT value FROM shared_state WHERE key = ?", (key,)).fetchone()
+                results[key] = (json.loads(row[0]) if row else 0) + amount
+                conn.execute(
+                    "INSERT INTO shared_state (key, value) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    (key, json.dumps(results[key]))
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return results
+    
+    def update(self, keys: List[str], fn: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Any]:
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            current = {}
+            for key in keys:
+                row = conn.execute("SELECT value FROM shared_state WHERE key = ?", (key,)).fetchone()
+                current[key] = json.loads(row[0]) if row else None
+            changes = fn(current)
+            for key, value in changes.items():
+                conn.execute(
+                    "INSERT INTO shared_state (key, value) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    (key, json.dumps(value))
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return changes
+    
+    def items(self, prefix: str) -> Dict[str, Any]:
+        rows = self._connect().execute(
+            "SELECT key, value FROM shared_state WHERE substr(key, 1, ?) = ?",
+            (len(prefix), prefix)
+        ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+def create_state_store(url: Optional[str]) -> SharedStateStore:
+    """Build a store from a URL such as 'sqlite:///data/cluster.db' or 'memory'"""
+    if not url or url == 'memory':
+        return InMemoryStateStore()
+    if url.startswith('sqlite:///'):
+        return SQLiteStateStore(url[len('sqlite:///'):])
+    raise ValueError(f"Unsupported state store: {url}")
+
+class ConsistentHashRing:
+    """Maps session ids to workers so membership changes move few sessions"""
+    
+    def __init__(self, nodes: Optional[List[str]] = None, replicas: int = 100):
+        self.replicas = replicas
+        self.nodes = set()
+        self._ring = []
+        for node in nodes or []:
+            self.add(node)
+    
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+    
+    def add(self, node: str):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.replicas):
+            bisect.insort(self._ring, (self._hash(f"{node}#{i}"), node))
+    
+    def remove(self, node: str):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        self._ring = [entry for entry in self._ring if entry[1] != node]
+    
+    def get_node(self, key: str) -> Optional[str]:
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._ring, (self._hash(key), '')) % len(self._ring)
+        return self._ring[index][1]
+
+class ClusterCoordinator:
+    """Worker membership, session affinity and request forwarding through a shared store"""
+    
+    def __init__(self, store: SharedStateStore, worker_id: str, worker_url: Optional[str] = None,
+                 heartbeat_ttl: float = 15.0, internal_token: Optional[str] = None):
+        self.store = store
+        self.worker_id = worker_id
+        self.worker_url = worker_url
+        self.heartbeat_ttl = heartbeat_ttl
+        self.internal_token = internal_token
+        self.instance = f"{socket.gethostname()}:{os.getpid()}"
+        self.ring = ConsistentHashRing([worker_id])
+        self.workers = {}
+        self._http = None
+    
+    def join(self, status: Dict):
+        """Register this worker, refusing to share its id with another live process"""
+        existing = self.store.get(f'worker:{self.worker_id}')
+        if existing and existing.get('instance') != self.instance \
+                and existing['last_seen'] >= time.time() - self.heartbeat_ttl:
+            raise RuntimeError(
+                f"Worker id {self.worker_id} is in use by {existing.get('instance')}; "
+                f"give each worker its own AI_WORKER_ID"
+            )
+        self.heartbeat(status)
+    
+    def heartbeat(self, status: Dict):
+        """Publish this worker's status and refresh ring membership"""
+        self.store.set(f'worker:{self.worker_id}', {
+            **status,
+            'worker_id': self.worker_id,
+            'instance': self.instance,
+            'url': self.worker_url,
+            'last_seen': time.time()
+        })
+        # Kept locally so request routing never has to wait on the store
+        self.workers = {worker['worker_id']: worker for worker in self.live_workers()}
+        live = set(self.workers) | {self.worker_id}
+        for node in live - self.ring.nodes:
+            self.ring.add(node)
+        for node in self.ring.nodes - live:
+            self.ring.remove(node)
+    
+    def live_workers(self) -> List[Dict]:
+        cutoff = time.time() - self.heartbeat_ttl
+        return [worker for worker in self.store.items('worker:').values() if worker['last_seen'] >= cutoff]
+    
+    def leave(self):
+        self.store.delete(f'worker:{self.worker_id}')
+    
+    def owner(self, session_id: str) -> Optional[Dict]:
+        """Worker record owning a session, or None if this worker owns it"""
+        node = self.ring.get_node(session_id)
+        if node is None or node == self.worker_id:
+            return None
+        return self.workers.get(node)
+    
+    async def forward(self, url: str, path: str, payload: Dict, headers: Dict[str, str]) -> Tuple[int, Dict]:
+        """Replay a request on the owning worker"""
+        if self._http is None:
+            self._http = httpx.AsyncClient(timeout=httpx.Timeout(600.0, connect=5.0))
+        response = await self._http.post(
+            url.rstrip('/') + path,
+            json=payload,
+            headers={
+                **headers,
+                'X-Forwarded-Worker': self.worker_id,
+                'X-Internal-Token': self.internal_token or ''
+            }
+        )
+        return response.status_code, response.json() if response.content else {}
+    
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+class BudgetExceeded(Exception):
+    """Raised when a call would exceed a caller or category budget"""
+    pass
+
+@dataclass
+class BudgetReservation:
+    """Worst-case cost of an allowed call, held against its budget windows until recorded"""
+    llm_type: LLMType
+    caller: str
+    category: str
+    window: int
+    amount: float = 0.0
+
+class UsageAccountant:
+    """Token and cost accounting with per-caller and per-category budgets"""
+    
+    def __init__(self, store: SharedStateStore, llm_configs: Dict[str, Dict], budgets: Optional[Dict] = None):
+        self.store = store
+        self.llm_configs = llm_configs
+        budgets = budgets or {}
+        self.policy = budgets.get('policy', 'degrade')
+        self.window_seconds = budgets.get('window_seconds', 86400)
+        self.caller_limits = budgets.get('callers', {})
+        self.category_limits = budgets.get('categories', {})
+        self._encodings = {}
+    
+    def estimate_tokens(self, text: str, llm_type: LLMType) -> int:
+        """Count tokens locally; falls back to ~4 characters per token without tiktoken"""
+        if tiktoken is None:
+            return max(1, len(text) // 4)
+        model = self.llm_configs.get(llm_type.value, {}).get('model', '')
+        try:
+            if model not in self._encodings:
+                try:
+                    self._encodings[model] = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    self._encodings[model] = tiktoken.get_encoding('cl100k_base')
+            return len(self._encodings[model].encode(text, disallowed_special=()))
+        except Exception as e:
+            # Encodings are downloaded on first use; an offline worker must still answer
+            logger.warning(f"tiktoken unavailable for {model or llm_type.value}: {e}")
+            return max(1, len(text) // 4)
+    
+    def cost(self, llm_type: LLMType, prompt_tokens: int, completion_tokens: int) -> float:
+        config = self.llm_configs.get(llm_type.value, {})
+        return (prompt_tokens * config.get('prompt_price_per_1k', 0.0)
+                + completion_tokens * config.get('completion_price_per_1k', 0.0)) / 1000
+    
+    def _window(self) -> int:
+        return int(time.time() // self.window_seconds)
+    
+    def _limit(self, limits: Dict[str, float], name: Optional[str]) -> Optional[float]:
+        return limits.get(name, limits.get('default')) if name else limits.get('default')
+    
+    def _priced(self, llm_type: LLMType) -> bool:
+        config = self.llm_configs.get(llm_type.value, {})
+        return 'prompt_price_per_1k' in config and 'completion_price_per_1k' in config
+    
+    def _reserve(self, llm_type: LLMType, caller: str, category: str,
+                 prompt_tokens: int) -> Optional[BudgetReservation]:
+        """Atomically hold the call's worst-case cost if it fits every applicable budget"""
+        window = self._window()
+        limits = {
+            f'usage:spend:caller:{caller}:{window}': self._limit(self.caller_limits, caller),
+            f'usage:spend:category:{category}:{window}': self._limit(self.category_limits, category)
+        }
+        if all(limit is None for limit in limits.values()):
+            return BudgetReservation(llm_type, caller, category, window)
+        if not self._priced(llm_type):
+            # Would be recorded at $0, so it can't be held to a budget
+            return None
+        
+        # Worst case: the model uses its full completion allowance
+        max_tokens = self.llm_configs.get(llm_type.value, {}).get('max_tokens', 0)
+        expected = self.cost(llm_type, prompt_tokens, max_tokens)
+        
+        def claim(current: Dict) -> Dict:
+            spent = {key: current[key] or 0 for key in limits}
+            if any(limit is not None and spent[key] + expected > limit for key, limit in limits.items()):
+                return {}
+            return {key: spent[key] + expected for key in limits}
+        
+        if not self.store.update(list(limits), claim):
+            return None
+        return BudgetReservation(llm_type, caller, category, window, expected)
+    
+    def enforce(self, llm_type: LLMType, caller: Optional[str], category: str,
+                prompt_tokens: int, available: List[LLMType]) -> BudgetReservation:
+        """Reserve budget for the requested model or, under 'degrade', the closest cheaper one
+        
+        Raises BudgetExceeded if none fits. Concurrent calls can't overshoot a budget because
+        each reservation is checked and taken in one atomic store update.
+        """
+        caller = caller or 'anonymous'
+        reservation = self._reserve(llm_type, caller, category, prompt_tokens)
+        if reservation:
+            return reservation
+        if self.policy == 'degrade':
+            requested_cost = self.cost(llm_type, 1000, 1000)
+            cheaper = sorted(
+                (llm for llm in available if self._priced(llm) and self.cost(llm, 1000, 1000) < requested_cost),
+                key=lambda llm: self.cost(llm, 1000, 1000),
+                reverse=True
+            )
+            for candidate in cheaper:
+                reservation = self._reserve(candidate, caller, category, prompt_tokens)
+                if reservation:
+                    logger.info(f"Budget: degraded {llm_type.value} to {candidate.value} for {caller}/{category}")
+                    return reservation
+        raise BudgetExceeded(f"Budget exceeded for caller {caller} or category {category}")
+    
+    def release(self, reservation: BudgetReservation):
+        """Return a reservation whose call failed"""
+        if reservation.amount:
+            self.store.incr_many({
+                f'usage:spend:caller:{reservation.caller}:{reservation.window}': -reservation.amount,
+                f'usage:spend:category:{reservation.category}:{reservation.window}': -reservation.amount
+            })
+    
+    def record_result(self, llm_type: LLMType, caller: Optional[str], category: str,
+                      result: LLMResult, prompt: str, reservation: Optional[BudgetReservation] = None) -> Dict:
+        """Record a call from the provider-reported token usage, estimating only when it is missing
+        
+        Returns the token counts and cost that were recorded.
+        """
+        usage = (result.llm_output or {}).get('token_usage') or {}
+        if 'prompt_tokens' in usage and 'completion_tokens' in usage:
+            tokens = {'prompt_tokens': usage['prompt_tokens'], 'completion_tokens': usage['completion_tokens'],
+                      'estimated': False}
+        else:
+            tokens = {'prompt_tokens': self.estimate_tokens(prompt, llm_type),
+                      'completion_tokens': self.estimate_tokens(result.generations[0][0].text, llm_type),
+                      'estimated': True}
+        cost = self.record(llm_type, caller, category, tokens['prompt_tokens'], tokens['completion_tokens'],
+                           estimated=tokens['estimated'], reservation=reservation)
+        return {**tokens, 'cost': cost}
+    
+    def record(self, llm_type: LLMType, caller: Optional[str], category: str,
+               prompt_tokens: int, completion_tokens: int, estimated: bool = False,
+               reservation: Optional[BudgetReservation] = None) -> float:
+        """Add a completed call to the running totals and budget windows, settling its reservation"""
+        cost = self.cost(llm_type, prompt_tokens, completion_tokens)
+        window = reservation.window if reservation else self._window()
+        held = reservation.amount if reservation else 0.0
+        caller = caller or 'anonymous'
+        amounts = {
+            f'usage:spend:caller:{caller}:{window}': cost - held,
+            f'usage:spend:category:{category}:{window}': cost - held
+        }
+        for dimension, name in (('category', category), ('model', llm_type.value), ('caller', caller)):
+            amounts[f'usage:totals:{dimension}:{name}:prompt_tokens'] = prompt_tokens
+            amounts[f'usage:totals:{dimension}:{name}:completion_tokens'] = completion_tokens
+            amounts[f'usage:totals:{dimension}:{name}:cost'] = cost
+            amounts[f'usage:totals:{dimension}:{name}:calls'] = 1
+            if estimated:
+                amounts[f'usage:totals:{dimension}:{name}:estimated_calls'] = 1
+        self.store.incr_many(amounts)
+        return cost
+    
+    def export(self) -> Dict[str, float]:
+        """Totals and current-window spend, for snapshotting a process-local store"""
+        window = f':{self._window()}'
+        spend = {key: value for key, value in self.store.items('usage:spend:').items() if key.endswith(window)}
+        return {**self.store.items('usage:totals:'), **spend}
+    
+    def load(self, entries: Dict[str, float]):
+        """Restore entries written by export; windows that have already closed are skipped"""
+        window = f':{self._window()}'
+        for key, value in entries.items():
+            if key.startswith('usage:totals:') or (key.startswith('usage:spend:') and key.endswith(window)):
+                self.store.set(key, value)
+    
+    def get_totals(self) -> Dict:
+        """Token and cost totals grouped by category, model and caller"""
+        totals = {'categories': {}, 'models': {}, 'callers': {}, 'total_cost': 0.0}
+        groups = {'category': 'categories', 'model': 'models', 'caller': 'callers'}
+        for key, value in self.store.items('usage:totals:').items():
+            _, _, dimension, rest = key.split(':', 3)
+            name, metric = rest.rsplit(':', 1)
+            totals[groups[dimension]].setdefault(name, {})[metric] = value
+            if dimension == 'model' and metric == 'cost':
+                totals['total_cost'] += value
+        return totals
 
 class LangChainTestingSystem:
     """Main LangChain-based testing system with keyword routing"""
     
-    def __init__(self, config_dir: str = "./config", data_dir: str = "./data"):
+    def __init__(self, config_dir: str = "./config", data_dir: str = "./data",
+                 state_store: Optional[SharedStateStore] = None, worker_id: Optional[str] = None):
         self.config_dir = Path(config_dir)
         self.data_dir = Path(data_dir)
         self.config_dir.mkdir(exist_ok=True)
         self.data_dir.mkdir(exist_ok=True)
+        self.state_store = state_store or InMemoryStateStore()
+        self.worker_id = worker_id
         
         # Initialize components
-        self.router = KeywordRouter(self.config_dir / "routing_config.yaml")
+        self.router = KeywordRouter(
+            self.config_dir / "routing_config.yaml",
+            cache_size=int(os.getenv('AI_ROUTING_CACHE_SIZE', '10000'))
+        )
         self.api_keys = self._load_api_keys()
         self.models = self._initialize_models()
         self.chains = self._initialize_chains()
+        self.usage = self._initialize_usage()
         self.memory = ConversationBufferMemory()
+        self.max_sessions = int(os.getenv('AI_MAX_SESSIONS', '1000'))
+        self.session_memories = OrderedDict()
+        self.session_contexts = OrderedDict()
+        self.context_decay = float(os.getenv('AI_CONTEXT_DECAY', '0.8'))
         self.conversation_history = []
+        self.history_limit = int(os.getenv('AI_HISTORY_LIMIT', '1000'))
+        self.local_stats = self._empty_stats()
+        self.config_version = 0
+        self.sync_routing_config()
+        self.slow_queries = SlowQueryRecorder(
+            threshold_ms=float(os.getenv('AI_SLOW_QUERY_MS', '5000'))
+        )
+        self.state_path = self.data_dir / (f"router_state_{worker_id}.json" if worker_id else "router_state.json")
+        self._state_lock = None
+        self._replay = None
+        self._replay_source = None
+        self.ready = False
+        
+        # Provider SDK calls block; one thread per admitted query so the scheduler's
+        # concurrency limit is the real one (the default executor may be smaller)
+        self.llm_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv('AI_MAX_CONCURRENT_QUERIES', '8')),
+            thread_name_prefix='llm-call'
+        )
         
         logger.info(f"Initialized LangChain Testing System with {len(self.models)} models")
     
@@ -390,9 +1509,7 @@ class LangChainTestingSystem:
                 models[LLMType.OPENAI_GPT4] = ChatOpenAI(
                     model=llm_configs.get('openai_gpt4', {}).get('model', 'gpt-4'),
                     temperature=llm_configs.get('openai_gpt4', {}).get('temperature', 0.2),
-                    openai_api_key=self.api_keys['openai'],
-                    streaming=True,
-                    callbacks=[StreamingStdOutCallbackHandler()]
+                    openai_api_key=self.api_keys['openai']
                 )
                 models[LLMType.OPENAI_GPT35] = ChatOpenAI(
                     model=llm_configs.get('openai_gpt35', {}).get('model', 'gpt-3.5-turbo'),
@@ -446,6 +1563,23 @@ class LangChainTestingSystem:
         
         return models
     
+    def load_config_section(self, section: str) -> Dict:
+        """A top-level section of routing_config.yaml such as budgets or scheduler"""
+        config_path = self.config_dir / "routing_config.yaml"
+        if not config_path.exists():
+            return {}
+        with open(config_path, 'r') as f:
+            config = yaml.safe_load(f) or {}
+        return config.get(section) or {}
+    
+    def _initialize_usage(self) -> UsageAccountant:
+        """Set up token accounting from llm_configurations prices and budgets"""
+        return UsageAccountant(
+            self.state_store,
+            self.load_config_section('llm_configurations'),
+            self.load_config_section('budgets')
+        )
+    
     def _initialize_chains(self) -> Dict[str, LLMChain]:
         """Initialize specialized chains for different testing scenarios"""
         chains = {}
@@ -527,120 +1661,289 @@ Be specific to the technology stack and provide actionable advice."""
         
         return chains
     
-    async def process_query(self, query: str, context: Optional[Dict] = None) -> Dict:
+    def _get_memory(self, session_id: Optional[str] = None) -> ConversationBufferMemory:
+        """Conversation memory for a session; queries without a session share self.memory"""
+        if not session_id:
+            return self.memory
+        return self._lru_get(self.session_memories, session_id, ConversationBufferMemory)
+    
+    def _lru_get(self, entries: OrderedDict, session_id: str, factory) -> Any:
+        """Per-session entry, evicting the least recently used session past max_sessions"""
+        if session_id in entries:
+            entries.move_to_end(session_id)
+        else:
+            entries[session_id] = factory()
+            while len(entries) > self.max_sessions:
+                entries.popitem(last=False)
+        return entries[session_id]
+    
+    def _get_session_context(self, session_id: str, history: str = '') -> SessionContext:
+        """Context presence for a session; a new session starts from the history the client sent"""
+        def create() -> SessionContext:
+            session_context = SessionContext(decay=self.context_decay)
+            if history:
+                session_context.update(history, self.router.all_context_keywords())
+            return session_context
+        return self._lru_get(self.session_contexts, session_id, create)
+    
+    def sync_routing_config(self):
+        """Adopt routing rules from the shared store if another worker changed them"""
+        shared = self.state_store.get('routing_config')
+        if shared and shared['version'] != self.config_version:
+            self._apply_routing_config(shared)
+            logger.info(f"Loaded routing config version {shared['version']}")
+    
+    def _apply_routing_config(self, shared: Dict):
+        self.router.set_rules(KeywordRouter.parse_routing_rules(shared['rules']))
+        self.config_version = shared['version']
+    
+    async def process_query(self, query: str, context: Optional[Dict] = None,
+                            session_id: Optional[str] = None, caller: Optional[str] = None) -> Dict:
         """Process a query using keyword routing to select optimal LLM"""
+        started = time.perf_counter()
+        timings = {}
+        memory = self._get_memory(session_id)
         
         # Route query to appropriate category and LLM
+        history = context.get('conversation_history', '') if context else ''
         category, routing_config, confidence = self.router.route(
             query, 
-            context.get('conversation_history', '') if context else ''
+            history,
+            self._get_session_context(session_id, history) if session_id else None
         )
+        timings['routing'] = (time.perf_counter() - started) * 1000
         
         logger.info(f"Routed to category: {category} with confidence: {confidence:.2f}")
         logger.info(f"Using primary LLM: {routing_config.primary_llm.value}")
         
-        # Prepare full context
-        full_context = {
-            'conversation_history': self.memory.buffer,
-            'routing_info': {
+        primary_llm = routing_config.primary_llm
+        calls = []
+        error = None
+        try:
+            # Prepare full context
+            full_context = {
+                'conversation_history': memory.buffer,
+                'routing_info': {
+                    'category': category,
+                    'confidence': confidence,
+                    'primary_llm': routing_config.primary_llm.value
+                },
+                'user_context': context or {}
+            }
+            
+            # Get response from primary LLM; budgets may degrade it to a cheaper model
+            step = time.perf_counter()
+            primary_llm, primary_response = await self._get_llm_response(
+                routing_config.primary_llm,
+                category,
+                query,
+                full_context,
+                caller,
+                calls
+            )
+            timings[f'primary:{primary_llm.value}'] = (time.perf_counter() - step) * 1000
+            
+            # Get responses from secondary LLMs if configured
+            secondary_responses = []
+            if routing_config.secondary_llms and confidence < 0.9:
+                for llm_type in routing_config.secondary_llms[:2]:  # Limit to 2 secondary
+                    if llm_type in self.models:
+                        step = time.perf_counter()
+                        try:
+                            llm_type, response = await self._get_llm_response(
+                                llm_type,
+                                category,
+                                query,
+                                full_context,
+                                caller,
+                                calls,
+                                role='secondary'
+                            )
+                        except BudgetExceeded:
+                            logger.info(f"Skipping secondary {llm_type.value}: budget exceeded")
+                            continue
+                        timings[f'secondary:{llm_type.value}'] = (time.perf_counter() - step) * 1000
+                        secondary_responses.append(response)
+            
+            # Blend responses if multiple
+            if secondary_responses:
+                step = time.perf_counter()
+                final_response = await self._blend_responses(
+                    primary_response,
+                    secondary_responses,
+                    routing_config,
+                    caller,
+                    category,
+                    calls
+                )
+                timings['blend'] = (time.perf_counter() - step) * 1000
+            else:
+                final_response = primary_response
+            
+            # Update memory
+            memory.save_context(
+                {"input": query},
+                {"output": final_response}
+            )
+            if session_id:
+                self._get_session_context(session_id).update(
+                    f"{query}\n{final_response}", self.router.all_context_keywords()
+                )
+            
+            # Add to conversation history
+            self.conversation_history.append({
+                'timestamp': datetime.now().isoformat(),
+                'session_id': session_id,
+                'query': query,
                 'category': category,
+                'llm_used': primary_llm.value,
                 'confidence': confidence,
-                'primary_llm': routing_config.primary_llm.value
-            },
-            'user_context': context or {}
-        }
-        
-        # Get response from primary LLM
-        primary_response = await self._get_llm_response(
-            routing_config.primary_llm,
-            category,
-            query,
-            full_context
-        )
-        
-        # Get responses from secondary LLMs if configured
-        secondary_responses = []
-        if routing_config.secondary_llms and confidence < 0.9:
-            for llm_type in routing_config.secondary_llms[:2]:  # Limit to 2 secondary
-                if llm_type in self.models:
-                    response = await self._get_llm_response(
-                        llm_type,
-                        category,
-                        query,
-                        full_context
-                    )
-                    secondary_responses.append(response)
-        
-        # Blend responses if multiple
-        if secondary_responses:
-            final_response = self._blend_responses(
-                primary_response,
-                secondary_responses,
-                routing_config
-            )
-        else:
-            final_response = primary_response
-        
-        # Update memory
-        self.memory.save_context(
-            {"input": query},
-            {"output": final_response}
-        )
-        
-        # Add to conversation history
-        self.conversation_history.append({
-            'timestamp': datetime.now().isoformat(),
-            'query': query,
-            'category': category,
-            'llm_used': routing_config.primary_llm.value,
-            'confidence': confidence,
-            'response': final_response
-        })
+                'response': final_response
+            })
+            if len(self.conversation_history) > self.history_limit:
+                del self.conversation_history[:-self.history_limit]
+            self._record_local_stats(category, primary_llm.value, confidence)
+            await self._run_blocking(self.state_store.incr_many, {
+                'stats:total_queries': 1,
+                'stats:confidence_sum': confidence,
+                f'stats:categories:{category}': 1,
+                f'stats:models:{primary_llm.value}': 1
+            })
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            # Queries that fail (e.g. on budget) are recorded too; they are often the slow ones
+            total_ms = (time.perf_counter() - started) * 1000
+            if self.slow_queries.is_slow(total_ms):
+                self.slow_queries.observe(SlowQueryRecord(
+                    timestamp=datetime.now().isoformat(),
+                    query=query,
+                    category=category,
+                    confidence=confidence,
+                    primary_llm=primary_llm.value,
+                    secondary_llms=[llm.value for llm in routing_config.secondary_llms],
+                    query_chars=len(query),
+                    total_ms=total_ms,
+                    timings_ms=timings,
+                    calls=calls,
+                    error=error
+                ))
         
         return {
             'response': final_response,
             'metadata': {
                 'category': category,
-                'primary_llm': routing_config.primary_llm.value,
+                'primary_llm': primary_llm.value,
+                'degraded_from': routing_config.primary_llm.value if primary_llm != routing_config.primary_llm else None,
                 'secondary_llms': [llm.value for llm in routing_config.secondary_llms],
                 'confidence': confidence,
                 'keywords_matched': [kw for kw in routing_config.keywords if kw in query.lower()]
             }
         }
     
-    async def _get_llm_response(self, llm_type: LLMType, category: str, query: str, context: Dict) -> str:
-        """Get response from specific LLM"""
-        if llm_type not in self.models:
-            logger.warning(f"LLM {llm_type.value} not available")
-            return ""
+    async def _run_blocking(self, fn, *args, **kwargs) -> Any:
+        """Run a blocking call on the LLM executor without holding up the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.llm_executor, functools.partial(fn, *args, **kwargs))
+    
+    def _build_request(self, llm_type: LLMType, category: str, query: str,
+                       context: Dict) -> Tuple[Optional[Dict], str]:
+        """Chain inputs (None for a direct call) and the exact prompt text the LLM will receive"""
+        chain = self.chains.get(category)
+        if llm_type in self.models and chain is not None and chain.llm is self.models[llm_type]:
+            user_context = context.get('user_context', {})
+            inputs = {
+                'query': query,
+                'context': json.dumps(context),
+                'language': user_context.get('language', 'Python'),
+                'framework': user_context.get('framework', 'pytest')
+            }
+            if set(chain.prompt.input_variables) <= set(inputs):
+                inputs = {name: inputs[name] for name in chain.prompt.input_variables}
+                return inputs, chain.prompt.format(**inputs)
+        return None, self._direct_prompt(query, context)
+    
+    @staticmethod
+    def _direct_prompt(query: str, context: Dict) -> str:
+        return f"Context: {json.dumps(context)}\n\nQuery: {query}"
+    
+    def _call_llm(self, llm_type: LLMType, category: str, query: Optional[str], context: Optional[Dict],
+                  caller: Optional[str] = None, prompt: Optional[str] = None,
+                  calls: Optional[List[Dict]] = None, role: str = 'primary') -> Tuple[LLMType, str]:
+        """Budget check, provider call and usage accounting for one LLM call
         
-        llm = self.models[llm_type]
+        Blocks on the provider and the state store, so run it on llm_executor. A given
+        prompt is sent as-is instead of one built from query and context. Raises
+        BudgetExceeded if no model fits the budget, or the provider's error. If calls is
+        given, an entry with the prompt size, tokens and any error is appended to it.
+        """
+        def build(llm: LLMType) -> Tuple[Optional[Dict], str]:
+            if prompt is not None:
+                return None, prompt
+            return self._build_request(llm, category, query, context)
         
-        # Use appropriate chain if available
-        if category in self.chains:
-            try:
-                response = self.chains[category].run(
-                    query=query,
-                    context=json.dumps(context),
-                    language=context.get('user_context', {}).get('language', 'Python'),
-                    framework=context.get('user_context', {}).get('framework', 'pytest')
-                )
-                return response
-            except Exception as e:
-                logger.error(f"Chain execution error: {e}")
+        inputs, sent = build(llm_type)
+        call = {'role': role, 'llm': llm_type.value, 'prompt_chars': len(sent),
+                'prompt_tokens': self.usage.estimate_tokens(sent, llm_type), 'completion_tokens': None,
+                'estimated': True, 'error': None}
+        if calls is not None:
+            calls.append(call)
+        try:
+            reservation = self.usage.enforce(
+                llm_type, caller, category, call['prompt_tokens'], list(self.models.keys())
+            )
+        except BudgetExceeded as e:
+            call['error'] = f"BudgetExceeded: {e}"
+            raise
+        if reservation.llm_type != llm_type:
+            llm_type = reservation.llm_type
+            inputs, sent = build(llm_type)
+            call.update(llm=llm_type.value, prompt_chars=len(sent),
+                        prompt_tokens=self.usage.estimate_tokens(sent, llm_type))
         
-        # Fallback to direct LLM call
         try:
-            messages = [
-                HumanMessage(content=f"Context: {json.dumps(context)}\n\nQuery: {query}")
-            ]
-            response = llm.predict_messages(messages)
-            return response.content
+            if inputs is not None:
+                try:
+                    result = self.chains[category].generate([inputs])
+                except Exception as e:
+                    logger.error(f"Chain execution error: {e}")
+                    inputs, sent = None, self._direct_prompt(query, context)
+            
+            # Fallback to direct LLM call
+            if inputs is None:
+                prompt_value = ChatPromptValue(messages=[HumanMessage(content=sent)])
+                result = self.models[llm_type].generate_prompt([prompt_value])
+        except Exception as e:
+            self.usage.release(reservation)
+            call.update(prompt_chars=len(sent), error=f"{type(e).__name__}: {e}")
+            raise
+        
+        recorded = self.usage.record_result(llm_type, caller, category, result, sent, reservation)
+        call.update(prompt_chars=len(sent), prompt_tokens=recorded['prompt_tokens'],
+                    completion_tokens=recorded['completion_tokens'], estimated=recorded['estimated'])
+        return llm_type, result.generations[0][0].text
+    
+    async def _get_llm_response(self, llm_type: LLMType, category: str, query: str, context: Dict,
+                                caller: Optional[str] = None, calls: Optional[List[Dict]] = None,
+                                role: str = 'primary') -> Tuple[LLMType, str]:
+        """Get response from specific LLM, or a cheaper one the budget allows"""
+        if llm_type not in self.models:
+            logger.warning(f"LLM {llm_type.value} not available")
+            return llm_type, ""
+        
+        try:
+            return await self._run_blocking(self._call_llm, llm_type, category, query, context, caller,
+                                            calls=calls, role=role)
+        except BudgetExceeded:
+            raise
         except Exception as e:
             logger.error(f"LLM response error: {e}")
-            return f"Error getting response from {llm_type.value}: {str(e)}"
+            return llm_type, f"Error getting response from {llm_type.value}: {str(e)}"
     
-    def _blend_responses(self, primary: str, secondary: List[str], config: RoutingConfig) -> str:
+    async def _blend_responses(self, primary: str, secondary: List[str], config: RoutingConfig,
+                               caller: Optional[str] = None, category: str = 'general',
+                               calls: Optional[List[Dict]] = None) -> str:
         """Blend multiple LLM responses intelligently"""
         if not secondary:
             return primary
@@ -659,17 +1962,34 @@ Create a unified response that incorporates the best insights from all responses
         # Use primary LLM for blending
         if config.primary_llm in self.models:
             try:
-                messages = [HumanMessage(content=blend_prompt)]
-                blended = self.models[config.primary_llm].predict_messages(messages)
-                return blended.content
+                _, blended = await self._run_blocking(
+                    self._call_llm, config.primary_llm, category, None, None, caller, prompt=blend_prompt,
+                    calls=calls, role='blend'
+                )
+                return blended
+            except BudgetExceeded:
+                logger.info("Skipping blend: budget exceeded")
             except Exception as e:
                 logger.error(f"Blending error: {e}")
         
         return primary
     
     def update_routing_keywords(self, category: str, keywords: List[str], append: bool = True):
-        """Update routing keywords for a category"""
-        self.router.update_keywords(category, keywords, append)
+        """Update routing keywords for a category
+        
+        The rules live in the shared store and are changed in one atomic read-modify-write,
+        so updates taken by different workers build on each other instead of overwriting.
+        """
+        def apply(current: Dict) -> Dict:
+            shared = current['routing_config'] or {'version': self.config_version,
+                                                   'rules': self.router.serialize_rules()}
+            rules = shared['rules']
+            if category not in rules:
+                raise KeyError(f"Unknown category: {category}")
+            rules[category]['keywords'] = rules[category]['keywords'] + keywords if append else keywords
+            return {'routing_config': {'version': shared['version'] + 1, 'rules': rules}}
+        
+        self._apply_routing_config(self.state_store.update(['routing_config'], apply)['routing_config'])
         logger.info(f"Updated keywords for {category}")
     
     def add_api_key(self, service: str, key: str):
@@ -684,37 +2004,190 @@ Create a unified response that incorporates the best insights from all responses
         self.chains = self._initialize_chains()
         logger.info(f"Updated API key for {service}")
     
+    @staticmethod
+    def _empty_stats() -> Dict:
+        return {'total_queries': 0, 'confidence_sum': 0.0, 'categories': {}, 'models': {}}
+    
+    def _record_local_stats(self, category: str, model: str, confidence: float):
+        """Running aggregates behind get_routing_stats, independent of the capped history"""
+        self.local_stats['total_queries'] += 1
+        self.local_stats['confidence_sum'] += confidence
+        self.local_stats['categories'][category] = self.local_stats['categories'].get(category, 0) + 1
+        self.local_stats['models'][model] = self.local_stats['models'].get(model, 0) + 1
+    
+    def _claim_state_file(self) -> bool:
+        """Lock the state file so workers sharing data_dir don't overwrite each other's snapshots"""
+        if self._state_lock is None:
+            lock = open(self.state_path.with_suffix('.lock'), 'w')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._state_lock = lock
+            except BlockingIOError:
+                lock.close()
+                self._state_lock = False
+                logger.warning(f"{self.state_path} is owned by another worker; state snapshots disabled here")
+        return bool(self._state_lock)
+    
+    def capture_state(self) -> Dict:
+        """Copy in-process state for write_state
+        
+        Call this on the event loop: process_query mutates these structures there, and
+        serializing them from another thread can fail mid-iteration.
+        """
+        state = {
+            'version': 2,
+            'saved_at': datetime.now().isoformat(),
+            'stats': copy.deepcopy(self.local_stats),
+            # History entries are never modified once appended, so copying the list is enough
+            'conversation_history': self.conversation_history[-self.history_limit:]
+        }
+        # A shared store outlives the worker; a process-local one loses spend on restart
+        if isinstance(self.state_store, InMemoryStateStore):
+            state['usage'] = self.usage.export()
+        return state
+    
+    def write_state(self, state: Dict) -> Optional[Path]:
+        """Write state from capture_state to data_dir; blocks on the file system"""
+        if not self._claim_state_file():
+            return None
+        tmp_path = self.state_path.with_suffix('.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, default=str)
+        os.replace(tmp_path, self.state_path)
+        logger.info(f"Saved router state ({len(state['conversation_history'])} entries) to {self.state_path}")
+        return self.state_path
+    
+    def snapshot_state(self) -> Optional[Path]:
+        """Persist in-process state to data_dir so a restart can resume warm"""
+        return self.write_state(self.capture_state())
+    
+    def restore_state(self) -> bool:
+        """Restore state written by snapshot_state, if any"""
+        if not self._claim_state_file() or not self.state_path.exists():
+            return False
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading router state from {self.state_path}: {e}")
+            return False
+        
+        self.conversation_history = state.get('conversation_history', [])[-self.history_limit:]
+        if 'stats' in state:
+            self.local_stats = state['stats']
+        else:
+            for entry in self.conversation_history:
+                self._record_local_stats(entry['category'], entry['llm_used'], entry['confidence'])
+        if isinstance(self.state_store, InMemoryStateStore):
+            self.usage.load(state.get('usage', {}))
+        
+        # Only session memory is restored; the shared session-less memory starts empty so
+        # prompts don't keep growing across deploys
+        context_keywords = self.router.all_context_keywords()
+        for entry in self.conversation_history:
+            if not entry.get('session_id'):
+                continue
+            self._get_memory(entry['session_id']).save_context(
+                {"input": entry['query']},
+                {"output": entry['response']}
+            )
+            self._get_session_context(entry['session_id']).update(
+                f"{entry['query']}\n{entry['response']}", context_keywords
+            )
+        logger.info(f"Restored {len(self.conversation_history)} history entries saved at {state.get('saved_at')}")
+        return True
+    
+    def warm_up(self, top_n: int = 100, ping_providers: bool = False) -> Dict:
+        """Route frequent historical queries into the routing decision cache and optionally
+        open provider connections"""
+        frequent = Counter(entry['query'] for entry in self.conversation_history).most_common(top_n)
+        for query, _ in frequent:
+            self.router.route(query)
+        
+        pinged = []
+        if ping_providers:
+            for llm_type in list(self.models):
+                try:
+                    # Through _call_llm so pings count against the budget like any other call
+                    used, _ = self._call_llm(llm_type, 'warm_up', None, None, caller='warm-up', prompt='ping')
+                    pinged.append(used.value)
+                except Exception as e:
+                    logger.error(f"Warm-up ping failed for {llm_type.value}: {e}")
+        
+        self.ready = True
+        logger.info(f"Warm-up complete: {len(frequent)} queries routed, {len(pinged)} providers pinged")
+        return {'queries_warmed': len(frequent), 'providers_pinged': pinged}
+    
+    def replay_routing(self, candidate_rules: Dict[str, Dict], log_path: Optional[str] = None) -> Dict:
+        """Compare current routing against candidate rule overrides over logged queries"""
+        if log_path:
+            # Logs are read from data_dir only; the path comes from an admin request body
+            data_dir = self.data_dir.resolve()
+            path = (data_dir / log_path).resolve()
+            if not path.is_relative_to(data_dir):
+                raise ValueError(f"log_path must be inside {self.data_dir}")
+            source = (str(path), path.stat().st_mtime)
+        else:
+            source = ('history', len(self.conversation_history))
+        
+        # The match matrix is built once per log and reused across candidates
+        if self._replay is None or self._replay_source != source:
+            if log_path:
+                queries, contexts = [], []
+                with open(path, 'r') as f:
+                    for line in f:
+                        if line.strip():
+                            entry = json.loads(line)
+                            queries.append(entry['query'])
+                            contexts.append(entry.get('context') or '')
+                self._replay = RoutingReplay(queries, contexts if any(contexts) else None)
+            else:
+                self._replay = RoutingReplay([entry['query'] for entry in self.conversation_history])
+            self._replay_source = source
+        
+        baseline = self.router.routing_rules
+        candidate_data = self.router.serialize_rules()
+        for category, overrides in candidate_rules.items():
+            candidate_data[category] = {**candidate_data.get(category, {}), **overrides}
+        
+        return self._replay.compare(baseline, KeywordRouter.parse_routing_rules(candidate_data))
+    
     def get_routing_stats(self) -> Dict:
         """Get statistics about routing and model usage"""
+        total = self.local_stats['total_queries']
+        stats = {
+            'total_queries': total,
+            'categories': dict(self.local_stats['categories']),
+            'models': dict(self.local_stats['models']),
+            'average_confidence': self.local_stats['confidence_sum'] / total if total else 0.0
+        }
+        
+        stats['usage'] = self.usage.get_totals()
+        stats['routing_cache'] = self.router.keyword_cache.get_stats()
+        return stats
+    
+    def get_cluster_stats(self) -> Dict:
+        """Routing statistics aggregated across all workers sharing the state store"""
+        counters = self.state_store.items('stats:')
+        total = counters.get('stats:total_queries', 0)
         stats = {
-            'total_queries': len(self.conversation_history),
+            'total_queries': total,
             'categories': {},
             'models': {},
-            'average_confidence': 0.0
+            'average_confidence': counters.get('stats:confidence_sum', 0) / total if total else 0.0
         }
-        
-        if self.conversation_history:
-            total_confidence = 0
-            for entry in self.conversation_history:
-                # Category stats
-                cat = entry['category']
-                stats['categories'][cat] = stats['categories'].get(cat, 0) + 1
-                
-                # Model stats
-                model = entry['llm_used']
-                stats['models'][model] = stats['models'].get(model, 0) + 1
-                
-                # Confidence
-                total_confidence += entry['confidence']
-            
-            stats['average_confidence'] = total_confidence / len(self.conversation_history)
-        
+        for key, value in counters.items():
+            _, kind, *name = key.split(':', 2)
+            if kind in ('categories', 'models') and name:
+                stats[kind][name[0]] = value
+        stats['usage'] = self.usage.get_totals()
+        stats['routing_cache'] = self.router.keyword_cache.get_stats()
         return stats
 
 
 # FastAPI Integration
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Header, Request
+from fastapi.responses import FileResponse, PlainTextResponse, Response, JSONResponse
 from pydantic import BaseModel
 from typing import Optional, List
 
@@ -723,6 +2196,9 @@ class QueryRequest(BaseModel):
     context: Optional[Dict] = None
     language: Optional[str] = "Python"
     framework: Optional[str] = None
+    priority: Optional[str] = None
+    deadline_ms: Optional[float] = None
+    session_id: Optional[str] = None
 
 class KeywordUpdateRequest(BaseModel):
     category: str
@@ -733,15 +2209,197 @@ class APIKeyRequest(BaseModel):
     service: str
     key: str
 
+class ProfileStartRequest(BaseModel):
+    interval_ms: Optional[float] = None
+
+class SlowQueryConfigRequest(BaseModel):
+    threshold_ms: float
+
+class ReplayRequest(BaseModel):
+    routing_rules: Dict[str, Dict]
+    log_path: Optional[str] = None
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Guard for admin-only endpoints using the AI_ADMIN_TOKEN shared secret"""
+    admin_token = os.getenv('AI_ADMIN_TOKEN')
+    if not admin_token:
+        raise HTTPException(status_code=403, detail="Admin endpoints disabled - set AI_ADMIN_TOKEN")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, admin_token):
+        raise HTTPException(status_code=401, detail="Unauthorized - Admin access required")
+
+def is_internal_request(http_request: Request) -> bool:
+    """True when the request carries AI_INTERNAL_TOKEN, i.e. comes from the proxy or a peer worker"""
+    internal_token = os.getenv('AI_INTERNAL_TOKEN')
+    supplied = http_request.headers.get('x-internal-token')
+    return bool(internal_token and supplied and hmac.compare_digest(supplied, internal_token))
+
+def get_caller_id(http_request: Request) -> str:
+    """Identify the caller by its hashed credential; X-Caller-Id is only trusted from internal callers"""
+    credential = http_request.headers.get('x-api-key') or http_request.headers.get('authorization')
+    if credential:
+        return 'key-' + hashlib.sha256(credential.encode()).hexdigest()[:12]
+    caller = http_request.headers.get('x-caller-id')
+    if caller and is_internal_request(http_request):
+        return caller
+    # Behind the Node proxy every client shares one address, so don't pretend to tell them apart
+    return 'anonymous'
+
+def get_priority(request: 'QueryRequest', http_request: Request) -> str:
+    """Scheduling class for a query
+    
+    Interactive is reserved for user sessions (Bearer tokens) and internal callers.
+    API-key and unidentified traffic, such as CI jobs, always runs as batch.
+    """
+    requested = request.priority or http_request.headers.get('x-priority')
+    if requested and requested not in AdmissionScheduler.PRIORITY_CLASSES:
+        raise HTTPException(status_code=400, detail=f"Unknown priority: {requested}")
+    
+    authorization = http_request.headers.get('authorization', '')
+    may_be_interactive = is_internal_request(http_request) or (
+        authorization.lower().startswith('bearer ') and not http_request.headers.get('x-api-key')
+    )
+    if not may_be_interactive:
+        return 'batch'
+    return requested or 'interactive'
+
 # Create FastAPI app
 app = FastAPI(title="TestLab LangChain AI Router")
 
+def create_cluster() -> ClusterCoordinator:
+    """Coordinator for this worker; cluster mode runs one process per port, each with its own id"""
+    store_url = os.getenv('AI_CLUSTER_STORE')
+    if store_url:
+        missing = [name for name in ('AI_WORKER_ID', 'AI_WORKER_URL', 'AI_INTERNAL_TOKEN') if not os.getenv(name)]
+        if missing:
+            raise RuntimeError(
+                f"AI_CLUSTER_STORE requires {', '.join(missing)}. Run one process per port "
+                f"(not uvicorn --workers) with a distinct AI_WORKER_ID and AI_WORKER_URL each"
+            )
+    return ClusterCoordinator(
+        create_state_store(store_url),
+        worker_id=os.getenv('AI_WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}",
+        worker_url=os.getenv('AI_WORKER_URL'),
+        heartbeat_ttl=3 * float(os.getenv('AI_HEARTBEAT_INTERVAL', '5')),
+        internal_token=os.getenv('AI_INTERNAL_TOKEN')
+    )
+
 # Initialize the system
-ai_system = LangChainTestingSystem()
+cluster = create_cluster()
+ai_system = LangChainTestingSystem(
+    state_store=cluster.store,
+    worker_id=os.getenv('AI_WORKER_ID')
+)
+cpu_profiler = SamplingProfiler()
+scheduler = AdmissionScheduler(
+    max_concurrent=int(os.getenv('AI_MAX_CONCURRENT_QUERIES', '8')),
+    max_queue_depth={
+        'interactive': int(os.getenv('AI_INTERACTIVE_QUEUE_DEPTH', '200')),
+        'batch': int(os.getenv('AI_BATCH_QUEUE_DEPTH', '1000'))
+    },
+    max_caller_depth=int(os.getenv('AI_CALLER_QUEUE_DEPTH', '50')),
+    caller_weights=ai_system.load_config_section('scheduler').get('caller_weights', {})
+)
+memory_profiler = MemoryProfiler()
+
+@app.on_event("startup")
+async def restore_and_warm_up():
+    """Restore saved state, start warm-up in the background, then start periodic snapshots"""
+    ai_system.restore_state()
+    
+    # Health reports warming_up (503) until this finishes; requests are still served meanwhile
+    app.state.warmup_task = asyncio.create_task(asyncio.to_thread(
+        ai_system.warm_up,
+        int(os.getenv('AI_WARMUP_QUERIES', '100')),
+        os.getenv('AI_WARMUP_PING_PROVIDERS', 'false').lower() == 'true'
+    ))
+    
+    await asyncio.to_thread(cluster.join, worker_status())
+    
+    interval = float(os.getenv('AI_SNAPSHOT_INTERVAL', '300'))
+    if interval > 0:
+        app.state.snapshot_task = asyncio.create_task(periodic_snapshot(interval))
+    
+    # Own thread: busy executors must not delay heartbeats past the TTL and drop this worker
+    app.state.heartbeat_thread = threading.Thread(
+        target=cluster_heartbeat,
+        args=(float(os.getenv('AI_HEARTBEAT_INTERVAL', '5')),),
+        name="cluster-heartbeat",
+        daemon=True
+    )
+    app.state.heartbeat_thread.start()
+
+def worker_status() -> Dict:
+    return {
+        'ready': ai_system.ready,
+        'models_initialized': len(ai_system.models),
+        'local_queries': len(ai_system.conversation_history)
+    }
+
+heartbeat_stop = threading.Event()
+
+def cluster_heartbeat(interval: float):
+    while not heartbeat_stop.wait(interval):
+        try:
+            cluster.heartbeat(worker_status())
+            ai_system.sync_routing_config()
+        except Exception as e:
+            logger.error(f"Cluster heartbeat error: {e}")
+
+async def periodic_snapshot(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(ai_system.write_state, ai_system.capture_state())
+        except Exception as e:
+            logger.error(f"Periodic snapshot error: {e}")
+
+@app.on_event("shutdown")
+async def save_state_on_shutdown():
+    """Cancel periodic snapshots and save final state"""
+    for task_name in ('warmup_task', 'snapshot_task'):
+        task = getattr(app.state, task_name, None)
+        if task:
+            task.cancel()
+    heartbeat_stop.set()
+    heartbeat_thread = getattr(app.state, 'heartbeat_thread', None)
+    if heartbeat_thread:
+        # A beat still in flight would re-register this worker after leave()
+        heartbeat_thread.join()
+    try:
+        cluster.leave()
+    except Exception as e:
+        logger.error(f"Cluster leave error: {e}")
+    await cluster.close()
+    ai_system.llm_executor.shutdown(wait=False, cancel_futures=True)
+    try:
+        ai_system.snapshot_state()
+    except Exception as e:
+        logger.error(f"Shutdown snapshot error: {e}")
 
 @app.post("/api/ai/query")
-async def process_query(request: QueryRequest):
+async def process_query(request: QueryRequest, http_request: Request):
     """Process a query using keyword-based LLM routing"""
+    priority = get_priority(request, http_request)
+    deadline = time.monotonic() + request.deadline_ms / 1000 if request.deadline_ms else None
+    caller = get_caller_id(http_request)
+    
+    # Pin sessions to their owning worker
+    forwarded = http_request.headers.get('x-forwarded-worker') and is_internal_request(http_request)
+    if request.session_id and not forwarded:
+        owner = cluster.owner(request.session_id)
+        if owner and owner.get('url'):
+            # The owner trusts peers, so send the priority decided here, not the client's
+            payload = {**request.model_dump(), 'priority': priority}
+            try:
+                status_code, body = await cluster.forward(
+                    owner['url'], '/api/ai/query', payload,
+                    {'X-Caller-Id': caller, 'X-Priority': priority}
+                )
+                return JSONResponse(body, status_code=status_code,
+                                    headers={'X-Session-Worker': owner['worker_id']})
+            except Exception as e:
+                logger.error(f"Forwarding to {owner['worker_id']} failed, serving locally: {e}")
+    
     try:
         context = request.context or {}
         if request.language:
@@ -749,8 +2407,14 @@ async def process_query(request: QueryRequest):
         if request.framework:
             context['framework'] = request.framework
         
-        result = await ai_system.process_query(request.query, context)
-        return result
+        async with scheduler.slot(caller, priority, deadline):
+            result = await ai_system.process_query(request.query, context, request.session_id, caller)
+        return JSONResponse(result, headers={'X-Session-Worker': cluster.worker_id})
+    except AdmissionRejected as e:
+        status_code = 429 if e.reason == 'queue_full' else 503
+        raise HTTPException(status_code=status_code, detail=str(e), headers={"Retry-After": "1"})
+    except BudgetExceeded as e:
+        raise HTTPException(status_code=429, detail=str(e))
     except Exception as e:
         logger.error(f"Query processing error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -759,12 +2423,15 @@ async def process_query(request: QueryRequest):
 async def update_keywords(request: KeywordUpdateRequest):
     """Update routing keywords for a category"""
     try:
-        ai_system.update_routing_keywords(
+        await asyncio.to_thread(
+            ai_system.update_routing_keywords,
             request.category,
             request.keywords,
             request.append
         )
         return {"message": f"Keywords updated for {request.category}"}
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -788,7 +2455,12 @@ async def get_configuration():
 @app.get("/api/ai/stats")
 async def get_routing_stats():
     """Get routing and usage statistics"""
-    return ai_system.get_routing_stats()
+    if os.getenv('AI_CLUSTER_STORE'):
+        return {
+            **await asyncio.to_thread(ai_system.get_cluster_stats),
+            'workers': len(cluster.workers)
+        }
+    return await asyncio.to_thread(ai_system.get_routing_stats)
 
 @app.get("/api/ai/categories")
 async def get_categories():
@@ -814,16 +2486,104 @@ async def get_available_models():
     }
 
 @app.get("/api/ai/health")
-async def health_check():
+async def health_check(response: Response):
     """Health check endpoint"""
+    if not ai_system.ready:
+        response.status_code = 503
+    workers = list(cluster.workers.values())
     return {
-        "status": "healthy",
+        "status": "healthy" if ai_system.ready else "warming_up",
         "models_initialized": len(ai_system.models),
         "categories_configured": len(ai_system.router.routing_rules),
         "config_dir": str(ai_system.config_dir),
-        "data_dir": str(ai_system.data_dir)
+        "data_dir": str(ai_system.data_dir),
+        "worker_id": cluster.worker_id,
+        "routing_config_version": ai_system.config_version,
+        "cluster": {
+            "workers": len(workers),
+            "workers_ready": sum(1 for worker in workers if worker.get('ready')),
+            "members": {worker['worker_id']: worker for worker in workers}
+        }
+    }
+
+@app.post("/api/ai/admin/profile/start", dependencies=[Depends(require_admin)])
+async def start_profile(request: ProfileStartRequest):
+    """Start sampling the running worker"""
+    try:
+        cpu_profiler.start(request.interval_ms / 1000 if request.interval_ms else None)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"message": "Profiler started", "interval_ms": cpu_profiler.interval * 1000}
+
+@app.post("/api/ai/admin/profile/stop", dependencies=[Depends(require_admin)])
+async def stop_profile():
+    """Stop sampling and return collapsed stacks for flamegraph.pl / speedscope"""
+    try:
+        folded = cpu_profiler.stop()
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(folded, headers={"X-Profile-Samples": str(cpu_profiler.samples)})
+
+@app.post("/api/ai/admin/memory/snapshot", dependencies=[Depends(require_admin)])
+async def take_memory_snapshot(limit: int = 25):
+    """Take a tracemalloc snapshot and use it as the diff baseline"""
+    return await asyncio.to_thread(memory_profiler.snapshot, limit)
+
+@app.get("/api/ai/admin/memory/diff", dependencies=[Depends(require_admin)])
+async def get_memory_diff(limit: int = 25):
+    """Diff current allocations against the last snapshot"""
+    try:
+        return await asyncio.to_thread(memory_profiler.diff, limit)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.post("/api/ai/admin/memory/stop", dependencies=[Depends(require_admin)])
+async def stop_memory_tracing():
+    """Stop tracemalloc to remove its overhead"""
+    memory_profiler.stop()
+    return {"message": "Memory tracing stopped"}
+
+@app.get("/api/ai/admin/slow-queries", dependencies=[Depends(require_admin)])
+async def get_slow_queries():
+    """Get recorded slow process_query calls"""
+    return {
+        "threshold_ms": ai_system.slow_queries.threshold_ms,
+        "records": ai_system.slow_queries.get_records()
     }
 
+@app.post("/api/ai/admin/snapshot", dependencies=[Depends(require_admin)])
+async def save_snapshot():
+    """Save router state to data_dir now"""
+    path = await asyncio.to_thread(ai_system.write_state, ai_system.capture_state())
+    if path is None:
+        raise HTTPException(status_code=409, detail="State file is owned by another worker")
+    return {"message": f"State saved to {path}"}
+
+@app.post("/api/ai/admin/replay", dependencies=[Depends(require_admin)])
+async def replay_routing(request: ReplayRequest):
+    """What-if: how would candidate routing rules shift logged traffic"""
+    try:
+        return await asyncio.to_thread(ai_system.replay_routing, request.routing_rules, request.log_path)
+    except (RuntimeError, FileNotFoundError, KeyError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/ai/admin/scheduler", dependencies=[Depends(require_admin)])
+async def get_scheduler_stats():
+    """Get admission scheduler queue depths and counters"""
+    return scheduler.get_stats()
+
+@app.post("/api/ai/admin/slow-queries/config", dependencies=[Depends(require_admin)])
+async def configure_slow_queries(request: SlowQueryConfigRequest):
+    """Change the slow query threshold"""
+    ai_system.slow_queries.threshold_ms = request.threshold_ms
+    return {"message": f"Slow query threshold set to {request.threshold_ms}ms"}
+
+@app.delete("/api/ai/admin/slow-queries", dependencies=[Depends(require_admin)])
+async def clear_slow_queries():
+    """Clear recorded slow queries"""
+    ai_system.slow_queries.clear()
+    return {"message": "Slow queries cleared"}
+
 if __name__ == "__main__":
     import uvicorn
     # Run on port 3003 to not conflict with existing TestLab services
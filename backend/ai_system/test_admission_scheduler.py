@@ -0,0 +1,199 @@
+# File Location: testlab/backend/ai_system/test_admission_scheduler.py
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from langchain.schema import Generation, LLMResult
+
+from langchain_router import AdmissionRejected, AdmissionScheduler, LangChainTestingSystem
+
+
+async def run_jobs(scheduler, jobs, work):
+    """Start jobs as (caller, priority, start_delay) and return completion order"""
+    finished = []
+
+    async def job(index, caller, priority, delay):
+        await asyncio.sleep(delay)
+        async with scheduler.slot(caller, priority):
+            await work()
+        finished.append(index)
+
+    await asyncio.gather(*(job(i, *spec) for i, spec in enumerate(jobs)))
+    return finished
+
+
+def test_interactive_requests_overtake_batch_backlog():
+    scheduler = AdmissionScheduler(max_concurrent=2)
+    jobs = [('ci', 'batch', 0)] * 20 + [(f'user{i}', 'interactive', 0.005) for i in range(3)]
+
+    finished = asyncio.run(run_jobs(scheduler, jobs, lambda: asyncio.to_thread(time.sleep, 0.02)))
+
+    interactive_positions = [finished.index(i) for i in range(20, 23)]
+    assert max(interactive_positions) < 6
+    assert scheduler.get_stats()['counters']['interactive_admitted'] == 3
+
+
+def test_batch_callers_share_slots_fairly():
+    scheduler = AdmissionScheduler(max_concurrent=1)
+    jobs = [('ci-a', 'batch', 0)] * 10 + [('ci-b', 'batch', 0.005)] * 3
+
+    finished = asyncio.run(run_jobs(scheduler, jobs, lambda: asyncio.sleep(0.01)))
+
+    # ci-b interleaves with ci-a's backlog instead of waiting behind all of it
+    assert max(finished.index(i) for i in range(10, 13)) < 9
+
+
+def test_rejects_when_expected_service_time_exceeds_deadline():
+    scheduler = AdmissionScheduler(max_concurrent=1)
+    scheduler.service_time_ewma = 1.0
+
+    async def acquire():
+        await scheduler.acquire('ci', 'batch', time.monotonic() + 0.1)
+
+    with pytest.raises(AdmissionRejected) as excinfo:
+        asyncio.run(acquire())
+    assert excinfo.value.reason == 'deadline'
+    assert scheduler.active == 0
+
+
+def test_drops_queued_request_when_deadline_expires():
+    scheduler = AdmissionScheduler(max_concurrent=1)
+
+    async def scenario():
+        await scheduler.acquire('ci', 'batch')
+        with pytest.raises(AdmissionRejected):
+            await scheduler.acquire('user', 'interactive', time.monotonic() + 0.05)
+        scheduler.release(0.01)
+
+    asyncio.run(scenario())
+    stats = scheduler.get_stats()
+    assert stats['queue_depth'] == {'interactive': 0, 'batch': 0}
+    assert stats['active'] == 0
+    assert stats['counters']['interactive_dropped_deadline'] == 1
+
+
+def test_rejects_when_queue_is_full():
+    scheduler = AdmissionScheduler(max_concurrent=1, max_queue_depth={'interactive': 1, 'batch': 1})
+
+    async def scenario():
+        await scheduler.acquire('ci', 'batch')
+        waiter = asyncio.create_task(scheduler.acquire('ci', 'batch'))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as excinfo:
+            await scheduler.acquire('ci', 'batch')
+        scheduler.release(0.01)
+        await waiter
+        scheduler.release(0.01)
+        return excinfo.value.reason
+
+    assert asyncio.run(scenario()) == 'queue_full'
+
+
+def test_caller_weights_scale_share_of_slots():
+    scheduler = AdmissionScheduler(max_concurrent=1, caller_weights={'heavy': 3.0})
+    jobs = [('light', 'batch', 0.001)] * 12 + [('heavy', 'batch', 0.001)] * 12
+
+    async def scenario():
+        await scheduler.acquire('holder', 'batch')
+        runner = asyncio.create_task(run_jobs(scheduler, jobs, lambda: asyncio.sleep(0.001)))
+        await asyncio.sleep(0.01)
+        scheduler.release(0.001)
+        return await runner
+
+    finished = asyncio.run(scenario())
+    first = [('heavy' if index >= 12 else 'light') for index in finished[:8]]
+    assert first.count('heavy') == 6
+
+
+def test_abandoned_waiters_free_queue_and_caller_depth():
+    scheduler = AdmissionScheduler(max_concurrent=1, max_queue_depth={'interactive': 1, 'batch': 1},
+                                   max_caller_depth=1)
+
+    async def scenario():
+        await scheduler.acquire('holder', 'batch')
+        with pytest.raises(AdmissionRejected):
+            await scheduler.acquire('ci', 'batch', time.monotonic() + 0.01)
+        cancelled = asyncio.create_task(scheduler.acquire('ci', 'batch'))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+
+        # Neither dropped waiter still counts against the class or the caller
+        assert scheduler.get_stats()['queue_depth']['batch'] == 0
+        waiter = asyncio.create_task(scheduler.acquire('ci', 'batch'))
+        await asyncio.sleep(0)
+        assert scheduler.get_stats()['queue_depth']['batch'] == 1
+        scheduler.release(0.01)
+        await waiter
+        scheduler.release(0.01)
+
+    asyncio.run(scenario())
+    assert scheduler.active == 0
+    assert not scheduler.caller_depth
+
+
+class BlockingModel:
+    """Stand-in for a provider SDK whose calls block the calling thread"""
+
+    def generate_prompt(self, prompts):
+        time.sleep(0.02)
+        return LLMResult(generations=[[Generation(text='ok')]])
+
+
+def test_process_query_runs_concurrently_under_scheduler(tmp_path):
+    system = LangChainTestingSystem(config_dir=str(tmp_path / 'config'), data_dir=str(tmp_path / 'data'))
+    _, routing_config, _ = system.router.route("query")
+    system.models = {routing_config.primary_llm: BlockingModel()}
+    system.chains = {}
+    scheduler = AdmissionScheduler(max_concurrent=2)
+
+    async def query(index, caller, priority, delay, finished):
+        await asyncio.sleep(delay)
+        async with scheduler.slot(caller, priority):
+            await system.process_query(f"query {index}")
+        finished.append(index)
+
+    async def scenario():
+        finished = []
+        jobs = [('ci', 'batch', 0)] * 10 + [('user', 'interactive', 0.005)] * 2
+        await asyncio.gather(*(query(i, *spec, finished) for i, spec in enumerate(jobs)))
+        return finished
+
+    finished = asyncio.run(scenario())
+    assert max(finished.index(i) for i in (10, 11)) < 5
+
+
+def test_llm_calls_use_every_admitted_slot(tmp_path, monkeypatch):
+    monkeypatch.setenv('AI_MAX_CONCURRENT_QUERIES', '4')
+    system = LangChainTestingSystem(config_dir=str(tmp_path / 'config'), data_dir=str(tmp_path / 'data'))
+    _, routing_config, _ = system.router.route("query")
+    running, peak, lock = [0], [0], threading.Lock()
+
+    class CountingModel:
+        def generate_prompt(self, prompts):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return LLMResult(generations=[[Generation(text='ok')]])
+
+    system.models = {routing_config.primary_llm: CountingModel()}
+    system.chains = {}
+    scheduler = AdmissionScheduler(max_concurrent=4)
+
+    async def query(index):
+        async with scheduler.slot('ci', 'batch'):
+            await system.process_query(f"query {index}")
+
+    async def scenario():
+        # A default executor smaller than the scheduler must not cap LLM concurrency
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=1))
+        await asyncio.gather(*(query(i) for i in range(4)))
+
+    asyncio.run(scenario())
+    assert peak[0] == 4
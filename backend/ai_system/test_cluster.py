@@ -0,0 +1,193 @@
+# File Location: testlab/backend/ai_system/test_cluster.py
+
+import asyncio
+import threading
+
+import httpx
+import pytest
+import yaml
+from fastapi import FastAPI, Request
+from langchain.schema import Generation, LLMResult
+
+import langchain_router
+from langchain_router import ConsistentHashRing, SharedStateStore, SQLiteStateStore, create_state_store
+
+SESSIONS = [f"session-{i}" for i in range(2000)]
+
+
+def test_ring_is_deterministic_across_instances():
+    first = ConsistentHashRing(['w1', 'w2', 'w3'])
+    second = ConsistentHashRing(['w3', 'w1', 'w2'])
+    assert [first.get_node(s) for s in SESSIONS] == [second.get_node(s) for s in SESSIONS]
+
+
+def test_adding_a_worker_only_moves_sessions_to_it():
+    ring = ConsistentHashRing(['w1', 'w2', 'w3'])
+    before = {s: ring.get_node(s) for s in SESSIONS}
+
+    ring.add('w4')
+    moved = [s for s in SESSIONS if ring.get_node(s) != before[s]]
+
+    assert all(ring.get_node(s) == 'w4' for s in moved)
+    assert 0.1 < len(moved) / len(SESSIONS) < 0.4
+
+
+def test_removing_a_worker_restores_previous_owners():
+    ring = ConsistentHashRing(['w1', 'w2', 'w3'])
+    before = {s: ring.get_node(s) for s in SESSIONS}
+
+    ring.add('w4')
+    ring.remove('w4')
+
+    assert {s: ring.get_node(s) for s in SESSIONS} == before
+
+
+def test_sqlite_incr_many_is_atomic_across_connections(tmp_path):
+    store = SQLiteStateStore(tmp_path / 'nested' / 'cluster.db')
+    threads, rounds = 8, 100
+
+    def worker():
+        # Each thread gets its own SQLite connection, like separate worker processes
+        for _ in range(rounds):
+            store.incr_many({'stats:total_queries': 1, 'stats:confidence_sum': 0.5})
+
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+
+    assert store.get('stats:total_queries') == threads * rounds
+    assert store.get('stats:confidence_sum') == threads * rounds * 0.5
+
+
+def test_sqlite_store_is_shared_between_instances(tmp_path):
+    path = tmp_path / 'cluster.db'
+    create_state_store(f"sqlite:///{path}").set('worker:w1', {'ready': True})
+    other = SQLiteStateStore(path)
+
+    assert other.items('worker:') == {'worker:w1': {'ready': True}}
+    other.delete('worker:w1')
+    assert other.get('worker:w1') is None
+
+
+def test_incomplete_store_fails_at_construction():
+    class PartialStore(SharedStateStore):
+        def get(self, key, default=None):
+            return default
+
+    with pytest.raises(TypeError):
+        PartialStore()
+
+
+def post_query(payload, headers):
+    async def send():
+        transport = httpx.ASGITransport(app=langchain_router.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://worker') as client:
+            return await client.post('/api/ai/query', json=payload, headers=headers)
+    return asyncio.run(send())
+
+
+def test_forwarded_request_carries_priority_decided_by_receiving_worker(monkeypatch):
+    forwarded = []
+
+    async def forward(url, path, payload, headers):
+        forwarded.append((payload, headers))
+        return 200, {'response': 'ok'}
+
+    monkeypatch.setattr(langchain_router.cluster, 'owner', lambda session_id: {'worker_id': 'w2', 'url': 'http://w2'})
+    monkeypatch.setattr(langchain_router.cluster, 'forward', forward)
+
+    response = post_query({'query': 'q', 'session_id': 's1', 'priority': 'interactive'}, {'X-API-Key': 'ci-key'})
+
+    assert response.status_code == 200
+    payload, headers = forwarded[0]
+    assert payload['priority'] == headers['X-Priority'] == 'batch'
+
+
+def test_keyword_updates_on_different_workers_are_not_lost(tmp_path):
+    store = SQLiteStateStore(tmp_path / 'cluster.db')
+    # Separate config dirs, as on different hosts
+    a = langchain_router.LangChainTestingSystem(str(tmp_path / 'a-config'), str(tmp_path / 'a-data'), store, 'a')
+    b = langchain_router.LangChainTestingSystem(str(tmp_path / 'b-config'), str(tmp_path / 'b-data'), store, 'b')
+
+    a.update_routing_keywords('debugging', ['stacktrace'])
+    b.update_routing_keywords('debugging', ['segfault'])  # before b has synced a's change
+    a.sync_routing_config()
+
+    for system in (a, b):
+        assert system.router.routing_rules['debugging'].keywords == ['stacktrace', 'segfault']
+        with open(system.config_dir / 'routing_config.yaml') as f:
+            assert yaml.safe_load(f)['routing_rules']['debugging']['keywords'] == ['stacktrace', 'segfault']
+    assert a.config_version == b.config_version == 2
+
+
+def test_unknown_category_leaves_shared_rules_untouched(tmp_path):
+    store = SQLiteStateStore(tmp_path / 'cluster.db')
+    system = langchain_router.LangChainTestingSystem(str(tmp_path / 'config'), str(tmp_path / 'data'), store)
+
+    with pytest.raises(KeyError):
+        system.update_routing_keywords('no_such_category', ['x'])
+    assert store.get('routing_config') is None
+
+
+def test_owner_comes_from_last_heartbeat_and_forward_is_async(tmp_path, monkeypatch):
+    store = SQLiteStateStore(tmp_path / 'cluster.db')
+    a = langchain_router.ClusterCoordinator(store, 'w1', 'http://w1', internal_token='secret')
+    b = langchain_router.ClusterCoordinator(store, 'w2', 'http://w2', internal_token='secret')
+    b.heartbeat({})
+    a.heartbeat({})
+    session = next(s for s in SESSIONS if a.ring.get_node(s) == 'w2')
+    assert a.owner(session)['url'] == 'http://w2'
+
+    peer = FastAPI()
+
+    @peer.post('/api/ai/query')
+    async def query(http_request: Request):
+        return {'internal': langchain_router.is_internal_request(http_request),
+                'from': http_request.headers['x-forwarded-worker']}
+
+    async def forward():
+        a._http = httpx.AsyncClient(transport=httpx.ASGITransport(app=peer))
+        try:
+            return await a.forward('http://w2', '/api/ai/query', {'query': 'q'}, {})
+        finally:
+            await a.close()
+
+    monkeypatch.setenv('AI_INTERNAL_TOKEN', 'secret')
+    assert asyncio.run(forward()) == (200, {'internal': True, 'from': 'w1'})
+
+
+class ThreadRecordingStore(langchain_router.InMemoryStateStore):
+    """Notes which threads touch the store"""
+
+    def __init__(self):
+        super().__init__()
+        self.threads = set()
+
+    def get(self, key, default=None):
+        self.threads.add(threading.current_thread())
+        return super().get(key, default)
+
+    def incr_many(self, amounts):
+        self.threads.add(threading.current_thread())
+        return super().incr_many(amounts)
+
+
+def test_query_path_keeps_store_io_off_the_event_loop(tmp_path):
+    store = ThreadRecordingStore()
+    system = langchain_router.LangChainTestingSystem(str(tmp_path / 'config'), str(tmp_path / 'data'), store)
+    system.usage.caller_limits = {'default': 100.0}
+    _, routing_config, _ = system.router.route("query")
+
+    class Model:
+        def generate_prompt(self, prompts):
+            return LLMResult(generations=[[Generation(text='ok')]])
+
+    system.models = {routing_config.primary_llm: Model()}
+    system.chains = {}
+    store.threads.clear()
+
+    asyncio.run(system.process_query("query", caller='key-abc'))
+
+    assert store.threads and threading.main_thread() not in store.threads
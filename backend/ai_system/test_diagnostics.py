@@ -0,0 +1,119 @@
+# File Location: testlab/backend/ai_system/test_diagnostics.py
+
+import asyncio
+import re
+import threading
+import time
+
+import httpx
+import pytest
+from langchain.schema import Generation, LLMResult
+
+import langchain_router
+from langchain_router import (BudgetExceeded, InMemoryStateStore, LangChainTestingSystem, SamplingProfiler,
+                              SlowQueryRecord, SlowQueryRecorder, UsageAccountant)
+
+PRICE = {'max_tokens': 1000, 'prompt_price_per_1k': 0.008, 'completion_price_per_1k': 0.024}
+
+
+class ReportingModel:
+    """Stand-in provider that reports token usage in llm_output"""
+
+    def generate_prompt(self, prompts):
+        return LLMResult(generations=[[Generation(text='answer')]],
+                         llm_output={'token_usage': {'prompt_tokens': 11, 'completion_tokens': 3}})
+
+
+def spin_for_profiler(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def make_record(total_ms):
+    return SlowQueryRecord(timestamp='now', query='q', category='general', confidence=0.5,
+                           primary_llm='claude_2', secondary_llms=[], query_chars=1, total_ms=total_ms)
+
+
+def make_system(tmp_path):
+    """System whose general category uses a primary, one secondary and a blend call"""
+    system = LangChainTestingSystem(config_dir=str(tmp_path / 'config'), data_dir=str(tmp_path / 'data'))
+    _, routing_config, _ = system.router.route("query")
+    system.models = {llm: ReportingModel() for llm in [routing_config.primary_llm, *routing_config.secondary_llms]}
+    system.chains = {}
+    system.slow_queries.threshold_ms = 0
+    return system, routing_config
+
+
+def test_profiler_emits_folded_stacks():
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    worker = threading.Thread(target=spin_for_profiler, args=(0.2,))
+    worker.start()
+    worker.join()
+    folded = profiler.stop()
+
+    lines = folded.splitlines()
+    assert lines and profiler.samples > 0
+    assert all(re.fullmatch(r'[^;]+(;[^;]+)* \d+', line) for line in lines)
+    assert any('spin_for_profiler (test_diagnostics.py' in line for line in lines)
+    assert not profiler.running
+
+
+def test_recorder_keeps_only_slow_queries_up_to_max_records():
+    recorder = SlowQueryRecorder(threshold_ms=100, max_records=3)
+
+    assert not recorder.observe(make_record(99))
+    for total_ms in (100, 200, 300, 400):
+        assert recorder.observe(make_record(total_ms))
+
+    assert [record['total_ms'] for record in recorder.get_records()] == [200, 300, 400]
+
+
+def test_slow_record_lists_each_call_with_its_prompt_size(tmp_path):
+    system, routing_config = make_system(tmp_path)
+
+    asyncio.run(system.process_query("query", context={'language': 'Go'}))
+
+    record, = system.slow_queries.get_records()
+    assert [call['role'] for call in record['calls']] == ['primary', 'secondary', 'blend']
+    assert [call['llm'] for call in record['calls']] == [
+        routing_config.primary_llm.value, routing_config.secondary_llms[0].value, routing_config.primary_llm.value
+    ]
+    for call in record['calls']:
+        assert call['prompt_chars'] > 0
+        assert (call['prompt_tokens'], call['completion_tokens'], call['estimated']) == (11, 3, False)
+        assert call['error'] is None
+    assert record['error'] is None
+
+
+def test_queries_that_raise_are_recorded(tmp_path):
+    system, routing_config = make_system(tmp_path)
+    system.usage = UsageAccountant(InMemoryStateStore(), {routing_config.primary_llm.value: PRICE},
+                                   {'policy': 'reject', 'callers': {'default': 0.0}})
+
+    with pytest.raises(BudgetExceeded):
+        asyncio.run(system.process_query("query"))
+
+    record, = system.slow_queries.get_records()
+    assert record['error'].startswith('BudgetExceeded')
+    call, = record['calls']
+    assert call['error'].startswith('BudgetExceeded')
+    assert call['completion_tokens'] is None
+
+
+def test_admin_endpoints_require_the_admin_token(monkeypatch):
+    async def get(headers):
+        transport = httpx.ASGITransport(app=langchain_router.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://worker') as client:
+            return await client.get('/api/ai/admin/slow-queries', headers=headers)
+
+    monkeypatch.delenv('AI_ADMIN_TOKEN', raising=False)
+    assert asyncio.run(get({'X-Admin-Token': 'anything'})).status_code == 403
+
+    monkeypatch.setenv('AI_ADMIN_TOKEN', 'secret')
+    assert asyncio.run(get({})).status_code == 401
+    assert asyncio.run(get({'X-Admin-Token': 'wrong'})).status_code == 401
+    response = asyncio.run(get({'X-Admin-Token': 'secret'}))
+    assert response.status_code == 200
+    assert 'records' in response.json()
@@ -0,0 +1,81 @@
+# File Location: testlab/backend/ai_system/test_routing_cache.py
+
+import threading
+
+from langchain_router import KeywordRouter, RoutingDecisionCache, SessionContext
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = RoutingDecisionCache(max_size=2)
+    cache.put('a', ('unit_testing', 1.0), 0)
+    cache.put('b', ('security_testing', 1.0), 0)
+    cache.get('a', 0)
+    cache.put('c', ('general', 0.5), 0)
+    assert cache.get('b', 0) is None
+    assert cache.get('a', 0) == ('unit_testing', 1.0)
+    assert cache.get_stats()['evictions'] == 1
+
+
+def test_entries_from_an_older_version_are_dropped_on_lookup():
+    cache = RoutingDecisionCache()
+    cache.put('a', ('unit_testing', 1.0), 0)
+    assert cache.get('a', 1) is None
+    stats = cache.get_stats()
+    assert (stats['stale'], stats['size']) == (1, 0)
+
+
+def test_hit_rate_counts_hits_and_misses():
+    cache = RoutingDecisionCache()
+    cache.get('a', 0)
+    cache.put('a', ('general', 0.5), 0)
+    cache.get('a', 0)
+    cache.get('a', 0)
+    stats = cache.get_stats()
+    assert (stats['hits'], stats['misses']) == (2, 1)
+    assert stats['hit_rate'] == 2 / 3
+
+
+def test_concurrent_access_keeps_cache_bounded_and_counts_consistent():
+    cache = RoutingDecisionCache(max_size=50)
+    lookups_per_thread = 2000
+
+    def work(offset):
+        for i in range(lookups_per_thread):
+            key = (offset + i) % 200
+            if cache.get(key, 0) is None:
+                cache.put(key, ('general', 0.5), 0)
+
+    threads = [threading.Thread(target=work, args=(n * 7,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.get_stats()
+    assert stats['size'] <= 50
+    assert stats['hits'] + stats['misses'] == 8 * lookups_per_thread
+
+
+def test_keyword_update_invalidates_cached_routes(tmp_path):
+    config_path = tmp_path / 'routing_config.yaml'
+    router = KeywordRouter(str(config_path))
+    query = "how should we cover the flibbertigibbet module"
+    before, _, _ = router.route(query)
+    assert router.route(query)[0] == before
+    target = next(category for category in router.routing_rules if category not in (before, 'general'))
+
+    router.update_keywords(target, ['flibbertigibbet'], append=False)
+    category, _, confidence = router.route(query)
+
+    uncached = KeywordRouter(str(config_path), cache_size=0).route(query)
+    assert (category, confidence) == (uncached[0], uncached[2]) == (target, 1.0)
+    assert router.keyword_cache.get_stats()['stale'] == 1
+
+
+def test_sessions_with_nearby_presence_share_cache_entries(tmp_path):
+    router = KeywordRouter(str(tmp_path / 'routing_config.yaml'))
+    router.routing_rules['integration_testing'].context_keywords = ['api']
+    first = SessionContext(presence={'api': 0.83})
+    second = SessionContext(presence={'api': 0.79, 'mock': 0.02})
+
+    assert router.route("write a test", session_context=first) == router.route("write a test", session_context=second)
+    assert router.keyword_cache.get_stats()['hits'] == 1
@@ -0,0 +1,98 @@
+# File Location: testlab/backend/ai_system/test_routing_replay.py
+
+import random
+
+import pytest
+import yaml
+
+pytest.importorskip("numpy")
+pytest.importorskip("scipy")
+
+from langchain_router import KeywordRouter, LangChainTestingSystem, RoutingReplay
+
+WORDS = ['unit test', 'mock', 'jest', 'api', 'login', 'slow', 'load', 'xss', 'sql', 'aria', 'review', 'bug']
+
+
+def make_router(tmp_path, seed):
+    rng = random.Random(seed)
+    rules = {
+        f'category_{i}': {
+            'keywords': rng.sample(WORDS, rng.randint(0, 3)),
+            'primary_llm': 'openai_gpt4',
+            'secondary_llms': ['claude_3'],
+            'weight': rng.choice([1.0, 0.9, 0.8]),
+            'context_keywords': rng.sample(WORDS, rng.randint(0, 2)),
+            'min_confidence': rng.choice([0.0, 0.3, 0.5])
+        }
+        for i in range(6)
+    }
+    config_path = tmp_path / 'routing_config.yaml'
+    config_path.write_text(yaml.dump({'routing_rules': rules}))
+    return KeywordRouter(str(config_path))
+
+
+def make_log(seed, size=3000):
+    rng = random.Random(seed)
+    queries = [' '.join(rng.choices(WORDS + ['Unit Test', 'foo'], k=rng.randint(0, 5))) for _ in range(size)]
+    contexts = [' '.join(rng.choices(WORDS + ['bar'], k=rng.randint(0, 3))) for _ in range(size)]
+    return queries, contexts
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_evaluate_matches_keyword_router(tmp_path, seed):
+    router = make_router(tmp_path, seed)
+    queries, contexts = make_log(seed)
+
+    names, assigned, confidence = RoutingReplay(queries, contexts).evaluate(router.routing_rules)
+
+    for i, (query, context) in enumerate(zip(queries, contexts)):
+        category, _, expected_confidence = router.route(query, context)
+        assert names[assigned[i]] == category
+        assert confidence[i] == pytest.approx(expected_confidence)
+
+
+def test_compare_reports_drops_to_general(tmp_path):
+    router = make_router(tmp_path, 4)
+    queries, _ = make_log(4)
+    candidate = KeywordRouter.parse_routing_rules({
+        category: {
+            'keywords': config.keywords,
+            'primary_llm': config.primary_llm.value,
+            'weight': config.weight,
+            'min_confidence': 1.1
+        }
+        for category, config in router.routing_rules.items()
+    })
+
+    report = RoutingReplay(queries).compare(router.routing_rules, candidate)
+
+    assert report['total_queries'] == len(queries)
+    assert report['general']['candidate'] == len(queries)
+    assert report['dropped_to_general'] == len(queries) - report['general']['baseline']
+    assert sum(t['count'] for t in report['transitions']) == report['changed']
+
+
+def test_empty_log(tmp_path):
+    router = make_router(tmp_path, 5)
+    report = RoutingReplay([]).compare(router.routing_rules, router.routing_rules)
+    assert report['total_queries'] == 0
+    assert report['changed'] == 0
+
+
+@pytest.mark.parametrize('log_path', ['../outside.jsonl', 'logs/../../outside.jsonl', None])
+def test_replay_rejects_log_paths_outside_data_dir(tmp_path, log_path):
+    system = LangChainTestingSystem(config_dir=str(tmp_path / 'config'), data_dir=str(tmp_path / 'data'))
+    outside = tmp_path / 'outside.jsonl'
+    outside.write_text('{"query": "unit test"}\n')
+
+    with pytest.raises(ValueError, match='inside'):
+        system.replay_routing({}, log_path or str(outside))
+
+
+def test_replay_reads_log_inside_data_dir(tmp_path):
+    system = LangChainTestingSystem(config_dir=str(tmp_path / 'config'), data_dir=str(tmp_path / 'data'))
+    (tmp_path / 'data' / 'queries.jsonl').write_text('{"query": "write a unit test"}\n{"query": "check xss"}\n')
+
+    report = system.replay_routing({}, 'queries.jsonl')
+    assert report['total_queries'] == 2
+    assert report['changed'] == 0
@@ -0,0 +1,81 @@
+# File Location: testlab/backend/ai_system/test_session_context.py
+
+import asyncio
+
+import pytest
+from langchain.schema import Generation, LLMResult
+
+from langchain_router import KeywordRouter, LangChainTestingSystem, SessionContext
+
+TURNS = [
+    "How do I test this endpoint?",
+    "It talks to the database through an API client",
+    "Should the fixture reset state between tests?",
+    "We mock the payment gateway",
+]
+
+
+def configure(router):
+    """Two categories that share a keyword and differ only in their context keywords"""
+    rules = router.routing_rules
+    rules['unit_testing'].keywords = ['test']
+    rules['unit_testing'].context_keywords = ['mock', 'fixture']
+    rules['integration_testing'].keywords = ['test']
+    rules['integration_testing'].context_keywords = ['api', 'database']
+    router.config_version += 1
+    return router
+
+
+def test_presence_decays_each_turn():
+    context = SessionContext(decay=0.8)
+    context.update("call the api", ['api'])
+    context.update("unrelated", ['api'])
+    context.update("unrelated", ['api'])
+    assert context.presence['api'] == pytest.approx(0.64)
+
+
+def test_faded_keywords_are_pruned():
+    context = SessionContext(decay=0.5)
+    context.update("call the api", ['api'])
+    for _ in range(6):
+        context.update("unrelated", ['api'])
+    assert context.presence['api'] == pytest.approx(0.5 ** 6)
+    context.update("unrelated", ['api'])
+    assert 'api' not in context.presence
+
+
+def test_least_recently_used_session_is_evicted(tmp_path, monkeypatch):
+    monkeypatch.setenv('AI_MAX_SESSIONS', '2')
+    system = LangChainTestingSystem(config_dir=str(tmp_path / 'config'), data_dir=str(tmp_path / 'data'))
+    for session_id in ('a', 'b', 'a', 'c'):
+        system._get_session_context(session_id)
+    assert list(system.session_contexts) == ['a', 'c']
+
+
+@pytest.mark.parametrize('upto', range(1, len(TURNS) + 1))
+def test_no_decay_routes_like_scanning_the_whole_conversation(tmp_path, upto):
+    router = configure(KeywordRouter(str(tmp_path / 'routing_config.yaml')))
+    session = SessionContext(decay=1.0)
+    for turn in TURNS[:upto]:
+        session.update(turn, router.all_context_keywords())
+
+    with_session = router.route("write a test", session_context=session)
+    with_text = router.route("write a test", "\n".join(TURNS[:upto]))
+    assert (with_session[0], with_session[2]) == (with_text[0], with_text[2])
+
+
+def test_new_session_starts_from_client_history(tmp_path):
+    system = LangChainTestingSystem(config_dir=str(tmp_path / 'config'), data_dir=str(tmp_path / 'data'))
+    configure(system.router)
+
+    class Model:
+        def generate_prompt(self, prompts):
+            return LLMResult(generations=[[Generation(text='ok')]])
+
+    system.models = {config.primary_llm: Model() for config in system.router.routing_rules.values()}
+    system.chains = {}
+    history = {'conversation_history': "the service writes to a database"}
+
+    with_session = asyncio.run(system.process_query("write a test", dict(history), session_id='s1'))
+    without_session = asyncio.run(system.process_query("write a test", dict(history)))
+    assert with_session['metadata']['category'] == without_session['metadata']['category'] == 'integration_testing'
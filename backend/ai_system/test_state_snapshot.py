@@ -0,0 +1,107 @@
+# File Location: testlab/backend/ai_system/test_state_snapshot.py
+
+import asyncio
+
+import httpx
+from langchain.schema import Generation, LLMResult
+
+import langchain_router
+from langchain_router import LangChainTestingSystem, RoutingDecisionCache
+
+
+class EchoModel:
+    """Stand-in provider that records the prompts it was sent"""
+
+    def __init__(self):
+        self.prompts = []
+
+    def generate_prompt(self, prompts):
+        self.prompts.append(prompts[0].to_messages()[-1].content)
+        return LLMResult(generations=[[Generation(text='answer')]])
+
+
+def make_system(tmp_path):
+    system = LangChainTestingSystem(config_dir=str(tmp_path / 'config'), data_dir=str(tmp_path / 'data'))
+    _, routing_config, _ = system.router.route("query")
+    system.models = {routing_config.primary_llm: EchoModel()}
+    system.chains = {}
+    return system
+
+
+def restart(system, tmp_path):
+    # The old process would have exited and released its lock on the state file
+    system._state_lock.close()
+    return LangChainTestingSystem(config_dir=str(tmp_path / 'config'), data_dir=str(tmp_path / 'data'))
+
+
+def test_snapshot_round_trips_history_and_stats(tmp_path):
+    system = make_system(tmp_path)
+    for query in ("write a unit test", "check for xss", "write a unit test"):
+        asyncio.run(system.process_query(query, session_id='s1'))
+    assert system.snapshot_state() == system.state_path
+
+    restored = restart(system, tmp_path)
+    assert restored.restore_state()
+    assert restored.conversation_history == system.conversation_history
+    assert restored.get_routing_stats()['total_queries'] == 3
+    assert restored.get_routing_stats()['categories'] == system.get_routing_stats()['categories']
+    assert 's1' in restored.session_contexts
+
+
+def test_captured_state_is_detached_from_live_stats(tmp_path):
+    system = make_system(tmp_path)
+    asyncio.run(system.process_query("write a unit test"))
+    state = system.capture_state()
+
+    asyncio.run(system.process_query("check for xss"))
+
+    assert state['stats']['total_queries'] == 1
+    assert sum(state['stats']['categories'].values()) == 1
+    assert len(state['conversation_history']) == 1
+
+
+def test_history_is_capped_by_history_limit(tmp_path, monkeypatch):
+    monkeypatch.setenv('AI_HISTORY_LIMIT', '2')
+    system = make_system(tmp_path)
+    for i in range(5):
+        asyncio.run(system.process_query(f"query {i}"))
+    system.snapshot_state()
+
+    restored = restart(system, tmp_path)
+    restored.restore_state()
+    assert [entry['query'] for entry in restored.conversation_history] == ['query 3', 'query 4']
+    assert restored.get_routing_stats()['total_queries'] == 5
+
+
+def test_warm_up_fills_routing_cache_and_accounts_pings(tmp_path):
+    system = make_system(tmp_path)
+    for query in ("write a unit test", "check for xss", "write a unit test"):
+        asyncio.run(system.process_query(query))
+    system.router.keyword_cache = RoutingDecisionCache()
+    (llm_type, model), = system.models.items()
+    calls_before = system.usage.get_totals()['models'][llm_type.value]['calls']
+
+    report = system.warm_up(ping_providers=True)
+
+    assert system.ready
+    assert report == {'queries_warmed': 2, 'providers_pinged': [llm_type.value]}
+    assert system.router.keyword_cache.get_stats()['size'] == 2
+    assert model.prompts[-1] == 'ping'
+    assert system.usage.get_totals()['models'][llm_type.value]['calls'] == calls_before + 1
+
+
+def test_health_returns_503_while_warming_up(monkeypatch):
+    async def health():
+        transport = httpx.ASGITransport(app=langchain_router.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://worker') as client:
+            return await client.get('/api/ai/health')
+
+    monkeypatch.setattr(langchain_router.ai_system, 'ready', False)
+    response = asyncio.run(health())
+    assert response.status_code == 503
+    assert response.json()['status'] == 'warming_up'
+
+    monkeypatch.setattr(langchain_router.ai_system, 'ready', True)
+    response = asyncio.run(health())
+    assert response.status_code == 200
+    assert response.json()['status'] == 'healthy'
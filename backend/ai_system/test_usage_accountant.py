@@ -0,0 +1,144 @@
+# File Location: testlab/backend/ai_system/test_usage_accountant.py
+
+import asyncio
+import threading
+
+import httpx
+import pytest
+from langchain.schema import Generation, LLMResult
+
+import langchain_router
+from langchain_router import (BudgetExceeded, InMemoryStateStore, LangChainTestingSystem, LLMType,
+                              SQLiteStateStore, UsageAccountant)
+
+
+class ReportingModel:
+    """Stand-in for a provider that reports token usage in llm_output"""
+
+    def __init__(self, token_usage=None):
+        self.token_usage = token_usage
+        self.prompts = []
+
+    def generate_prompt(self, prompts):
+        self.prompts.append(prompts[0].to_messages()[-1].content)
+        llm_output = {'token_usage': self.token_usage} if self.token_usage else None
+        return LLMResult(generations=[[Generation(text='answer')]], llm_output=llm_output)
+
+
+def make_system(tmp_path, model):
+    system = LangChainTestingSystem(config_dir=str(tmp_path / 'config'), data_dir=str(tmp_path / 'data'))
+    _, routing_config, _ = system.router.route("query")
+    system.models = {routing_config.primary_llm: model}
+    system.chains = {}
+    return system, routing_config.primary_llm
+
+
+def test_records_provider_reported_usage(tmp_path):
+    system, llm_type = make_system(tmp_path, ReportingModel({'prompt_tokens': 123, 'completion_tokens': 45}))
+    asyncio.run(system.process_query("query", caller='key:abc'))
+    totals = system.usage.get_totals()['models'][llm_type.value]
+    assert (totals['prompt_tokens'], totals['completion_tokens'], totals['calls']) == (123, 45, 1)
+    assert 'estimated_calls' not in totals
+
+
+def test_estimates_from_the_prompt_actually_sent(tmp_path):
+    model = ReportingModel()
+    system, llm_type = make_system(tmp_path, model)
+    asyncio.run(system.process_query("query"))
+    totals = system.usage.get_totals()['models'][llm_type.value]
+    assert totals['estimated_calls'] == 1
+    assert totals['prompt_tokens'] == system.usage.estimate_tokens(model.prompts[0], llm_type)
+
+
+def test_usage_survives_snapshot_and_restore(tmp_path):
+    system, llm_type = make_system(tmp_path, ReportingModel({'prompt_tokens': 10, 'completion_tokens': 5}))
+    asyncio.run(system.process_query("query", caller='key:abc'))
+    spend = system.usage.export()
+    system.snapshot_state()
+    system._state_lock.close()  # as if the previous process had exited
+
+    restored, _ = make_system(tmp_path, ReportingModel())
+    assert restored.restore_state()
+    assert restored.usage.export() == spend
+    assert restored.usage.get_totals()['callers']['key:abc']['calls'] == 1
+
+
+PRICES = {
+    'openai_gpt4': {'max_tokens': 1000, 'prompt_price_per_1k': 0.03, 'completion_price_per_1k': 0.06},
+    'claude_2': {'max_tokens': 1000, 'prompt_price_per_1k': 0.008, 'completion_price_per_1k': 0.024},
+    'openai_gpt35': {'max_tokens': 1000, 'prompt_price_per_1k': 0.0015, 'completion_price_per_1k': 0.002},
+    'cohere': {'max_tokens': 1000}
+}
+MODELS = [LLMType.OPENAI_GPT4, LLMType.CLAUDE_2, LLMType.OPENAI_GPT35, LLMType.COHERE]
+
+
+def accountant(limit, policy='degrade'):
+    return UsageAccountant(InMemoryStateStore(), PRICES, {'policy': policy, 'callers': {'default': limit}})
+
+
+def test_degrades_to_the_closest_cheaper_model_that_fits():
+    # gpt-4 needs $0.09 worst case; claude-2 $0.032 fits, so gpt-3.5 is not picked
+    reservation = accountant(0.05).enforce(LLMType.OPENAI_GPT4, 'key-ci', 'unit_testing', 1000, MODELS)
+    assert reservation.llm_type == LLMType.CLAUDE_2
+
+
+def test_unpriced_models_are_never_a_budget_fallback():
+    with pytest.raises(BudgetExceeded):
+        accountant(0.001).enforce(LLMType.OPENAI_GPT4, 'key-ci', 'unit_testing', 1000, MODELS)
+
+
+def test_reject_policy_does_not_degrade():
+    with pytest.raises(BudgetExceeded):
+        accountant(0.05, policy='reject').enforce(LLMType.OPENAI_GPT4, 'key-ci', 'unit_testing', 1000, MODELS)
+
+
+def test_recording_settles_the_reservation_and_release_returns_it():
+    usage = accountant(1.0)
+    key = f'usage:spend:caller:key-ci:{usage._window()}'
+
+    reservation = usage.enforce(LLMType.OPENAI_GPT4, 'key-ci', 'unit_testing', 1000, MODELS)
+    assert usage.store.get(key) == pytest.approx(0.09)
+    usage.record(LLMType.OPENAI_GPT4, 'key-ci', 'unit_testing', 1000, 500, reservation=reservation)
+    assert usage.store.get(key) == pytest.approx(0.06)
+
+    usage.release(usage.enforce(LLMType.OPENAI_GPT4, 'key-ci', 'unit_testing', 1000, MODELS))
+    assert usage.store.get(key) == pytest.approx(0.06)
+
+
+def test_concurrent_calls_cannot_overshoot_the_budget(tmp_path):
+    usage = UsageAccountant(SQLiteStateStore(tmp_path / 'cluster.db'), PRICES,
+                            {'policy': 'reject', 'callers': {'default': 0.9}})
+    allowed = []
+
+    def call():
+        try:
+            allowed.append(usage.enforce(LLMType.OPENAI_GPT4, 'key-ci', 'unit_testing', 1000, MODELS))
+        except BudgetExceeded:
+            pass
+
+    threads = [threading.Thread(target=call) for _ in range(30)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(allowed) == 10
+
+
+def test_query_endpoint_returns_429_when_budget_is_exhausted(monkeypatch):
+    system = langchain_router.ai_system
+    _, routing_config, _ = system.router.route("query")
+    monkeypatch.setattr(system, 'models', {routing_config.primary_llm: ReportingModel()})
+    monkeypatch.setattr(system, 'chains', {})
+    monkeypatch.setattr(system, 'usage', UsageAccountant(
+        InMemoryStateStore(), {routing_config.primary_llm.value: PRICES['openai_gpt4']},
+        {'policy': 'reject', 'callers': {'default': 0.0}}
+    ))
+
+    async def send():
+        transport = httpx.ASGITransport(app=langchain_router.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://worker') as client:
+            return await client.post('/api/ai/query', json={'query': 'query'}, headers={'X-API-Key': 'ci-key'})
+
+    response = asyncio.run(send())
+    assert response.status_code == 429
+    assert 'Budget exceeded' in response.json()['detail']